@@ -15,6 +15,26 @@ let g:ncm2_pyclang#sys_inc_args_fallback = get(g:, 'ncm2_pyclang#sys_inc_args_fa
 
 let g:ncm2_pyclang#detect_sys_inc_args = get(g:, 'ncm2_pyclang#detect_sys_inc_args', 1)
 
+let g:ncm2_pyclang#query_driver = get(g:, 'ncm2_pyclang#query_driver', [])
+
+let g:ncm2_pyclang#file_watcher = get(g:, 'ncm2_pyclang#file_watcher', 'inotify')
+
+let g:ncm2_pyclang#watch_poll_interval = get(g:, 'ncm2_pyclang#watch_poll_interval', 2)
+
+let g:ncm2_pyclang#tu_cache_size = get(g:, 'ncm2_pyclang#tu_cache_size', 16)
+
+let g:ncm2_pyclang#tu_cache_memory = get(g:, 'ncm2_pyclang#tu_cache_memory', 2048)
+
+let g:ncm2_pyclang#shared_tu = get(g:, 'ncm2_pyclang#shared_tu', 0)
+
+let g:ncm2_pyclang#workers = get(g:, 'ncm2_pyclang#workers', 0)
+
+let g:ncm2_pyclang#worker_process = get(g:, 'ncm2_pyclang#worker_process', 0)
+
+let g:ncm2_pyclang#max_queued_warmups = get(g:, 'ncm2_pyclang#max_queued_warmups', 4)
+
+let g:ncm2_pyclang#goto_deadline = get(g:, 'ncm2_pyclang#goto_deadline', 10)
+
 if !has_key(g:ncm2_pyclang#sys_inc_args_fallback, 'c')
    let g:ncm2_pyclang#sys_inc_args_fallback.c = [
                 \ '-isystem', '/usr/local/include',
@@ -35,10 +55,26 @@ let g:ncm2_pyclang#database_path = get(g:,
             \   'build/compile_commands.json'
             \   ])
 
+let g:ncm2_pyclang#database_discover_depth = get(g:,
+            \ 'ncm2_pyclang#database_discover_depth',
+            \ 0)
+
+let g:ncm2_pyclang#database_backend = get(g:,
+            \ 'ncm2_pyclang#database_backend',
+            \ 'python')
+
 let g:ncm2_pyclang#args_file_path = get(g:,
             \ 'ncm2_pyclang#args_file_path',
             \ ['.clang_complete'])
 
+let g:ncm2_pyclang#flags_file_path = get(g:,
+            \ 'ncm2_pyclang#flags_file_path',
+            \ ['compile_flags.txt'])
+
+let g:ncm2_pyclang#flag_providers = get(g:,
+            \ 'ncm2_pyclang#flag_providers',
+            \ ['cmake', 'kbuild', 'compile_flags', 'clang_complete'])
+
 let g:ncm2_pyclang#bin = get(g:, 'ncm2_pyclang#bin', "bin/ncm2_pyclang")
 
 let g:ncm2_pyclang#source = extend(get(g:, 'ncm2_pyclang#source', {}), {
@@ -80,13 +116,14 @@ func! ncm2_pyclang#on_warmup(ctx)
 
     call g:ncm2_pyclang#proc.try_notify('cache_add',
                 \ s:data(a:ctx),
-                \ getline(1, '$'))
+                \ s:lines())
 
     if get(b:, 'b:ncm2_pyclang_cache') == 0
         au BufDelete <buffer> call 
                     \ g:ncm2_pyclang#proc.try_notify(
                     \   'cache_del',
-                    \   expand('%:p'))
+                    \   expand('%:p'),
+                    \   str2nr(expand('<abuf>')))
     endif
 
     let b:ncm2_pyclang_cache = 1
@@ -96,13 +133,13 @@ func! ncm2_pyclang#on_complete(ctx)
     call g:ncm2_pyclang#proc.try_notify('on_complete',
                 \ a:ctx,
                 \ s:data({}),
-                \ getline(1, '$'))
+                \ s:lines())
 endfunc
 
 func! ncm2_pyclang#find_declaration()
     let pos = g:ncm2_pyclang#proc.call('find_declaration',
                 \ s:data(ncm2#context(g:ncm2_pyclang#source)),
-                \ getline(1, '$'))
+                \ s:lines())
     if empty(pos)
         echohl ErrorMsg
         echom "Cannot find declaration"
@@ -111,58 +148,89 @@ func! ncm2_pyclang#find_declaration()
     return pos
 endfunc
 
+let s:goto_id = 0
+let s:goto_pending = {}
+
 func! ncm2_pyclang#goto_declaration()
-    let pos = ncm2_pyclang#find_declaration()
-    if empty(pos)
-        return
-    endif
-    let filepath = expand("%:p")
-    if filepath != pos.file
-        let fes = fnameescape(pos.file)
-        exe 'edit' fes
-    else
-        normal! m'
-    endif
-    call cursor(pos.lnum, pos.bcol)
+    call s:goto_declaration_async('edit')
 endfunc
 
 func! ncm2_pyclang#goto_declaration_split()
-    let pos = ncm2_pyclang#find_declaration()
-    if empty(pos)
+    call s:goto_declaration_async('split')
+endfunc
+
+func! ncm2_pyclang#goto_declaration_vsplit()
+    call s:goto_declaration_async('vsplit')
+endfunc
+
+func! s:goto_declaration_async(cmd)
+    call ncm2_pyclang#cancel_goto()
+    let s:goto_id += 1
+    let s:goto_pending = {'id': s:goto_id,
+                \ 'cmd': a:cmd,
+                \ 'bufnr': bufnr('%'),
+                \ 'curpos': getcurpos()}
+    call g:ncm2_pyclang#proc.notify('find_declaration_async',
+                \ s:goto_id,
+                \ s:data(ncm2#context(g:ncm2_pyclang#source)),
+                \ s:lines())
+    echo 'Looking for declaration...'
+endfunc
+
+func! ncm2_pyclang#cancel_goto()
+    if empty(s:goto_pending)
         return
     endif
-    let filepath = expand("%:p")
-    if filepath != pos.file
-        let fes = fnameescape(pos.file)
-        exe 'split' fes
-    else
-        normal! m'
-    endif
-    call cursor(pos.lnum, pos.bcol)
+    call g:ncm2_pyclang#proc.try_notify('cancel_declaration',
+                \ s:goto_pending.id)
+    let s:goto_pending = {}
 endfunc
 
-func! ncm2_pyclang#goto_declaration_vsplit()
-    let pos = ncm2_pyclang#find_declaration()
-    if empty(pos)
+func! ncm2_pyclang#on_declaration(id, pos, errors)
+    if empty(s:goto_pending) || s:goto_pending.id != a:id
+        " canceled
         return
     endif
+    let pending = s:goto_pending
+    let s:goto_pending = {}
+    if bufnr('%') != pending.bufnr || getcurpos() != pending.curpos
+        " the user has moved on
+        echo ''
+        return
+    endif
+    if empty(a:pos)
+        for err in a:errors
+            call ncm2_pyclang#error(err)
+        endfor
+        echohl ErrorMsg
+        echom "Cannot find declaration"
+        echohl None
+        return
+    endif
+    echo ''
+    call s:jump(pending.cmd, a:pos)
+endfunc
+
+func! s:jump(cmd, pos)
     let filepath = expand("%:p")
-    if filepath != pos.file
-        let fes = fnameescape(pos.file)
-        exe 'vsplit' fes
+    if filepath != a:pos.file
+        let fes = fnameescape(a:pos.file)
+        exe a:cmd fes
     else
         normal! m'
     endif
-    call cursor(pos.lnum, pos.bcol)
+    call cursor(a:pos.lnum, a:pos.bcol)
 endfunc
 
-
-
 func! ncm2_pyclang#get_args_dir()
     return g:ncm2_pyclang#proc.call('get_args_dir',
                 \ s:data(ncm2#context(g:ncm2_pyclang#source)))
 endfunc
 
+func! ncm2_pyclang#stats()
+    return g:ncm2_pyclang#proc.call('get_stats')
+endfunc
+
 func! ncm2_pyclang#error(msg)
     call g:ncm2_pyclang#proc.error(a:msg)
 endfunc
@@ -171,10 +239,33 @@ func! ncm2_pyclang#warn(msg)
     call g:ncm2_pyclang#proc.warn(a:msg)
 endfunc
 
+func! ncm2_pyclang#synced(bufnr, changedtick)
+    if has('nvim-0.5') && bufexists(a:bufnr)
+        call luaeval('require("ncm2_pyclang").ack(_A[1], _A[2])',
+                    \ [a:bufnr, a:changedtick])
+    endif
+endfunc
+
+func! ncm2_pyclang#resync(bufnr)
+    if has('nvim-0.5') && bufexists(a:bufnr)
+        call luaeval('require("ncm2_pyclang").resync(_A)', a:bufnr)
+    endif
+endfunc
+
+func! s:lines()
+    if has('nvim-0.5')
+        return luaeval('require("ncm2_pyclang").lines(_A)', bufnr('%'))
+    endif
+    return getline(1, '$')
+endfunc
+
 func! s:data(context)
     return  {'cwd': getcwd(),
                 \ 'database_path': g:ncm2_pyclang#database_path,
+                \ 'database_discover_depth': g:ncm2_pyclang#database_discover_depth,
+                \ 'database_backend': g:ncm2_pyclang#database_backend,
                 \ 'args_file_path': g:ncm2_pyclang#args_file_path,
+                \ 'flags_file_path': g:ncm2_pyclang#flags_file_path,
                 \ 'context': a:context,
                 \ }
 endfunc
@@ -0,0 +1,100 @@
+-- Tracks the lines changed in the buffers since they were last sent to the
+-- proc, so that only the changed lines are sent with each request.
+
+local M = {}
+
+-- bufnr -> true
+local attached = {}
+-- bufnr -> changedtick of the lines last sent to the proc
+local synced = {}
+-- bufnr -> changedtick of a full copy the proc has confirmed, a request may
+-- be dropped, e.g. before the proc has started
+local acked = {}
+-- bufnr -> {first, old_last, new_last}: the lines [first, old_last) of the
+-- synced lines are now the lines [first, new_last), or 'reload'
+local dirty = {}
+
+local function on_lines(_, buf, _, first, last, new_last)
+  local d = dirty[buf]
+  if d == 'reload' then
+    return
+  end
+  if d == nil then
+    dirty[buf] = {first, last, new_last}
+    return
+  end
+  local f, ol, nl = d[1], d[2], d[3]
+  -- lines past the dirty range are shifted by nl - ol from the synced ones
+  dirty[buf] = {math.min(f, first),
+                math.max(ol, last + ol - nl),
+                math.max(nl, last) + new_last - last}
+end
+
+local function forget(buf)
+  synced[buf] = nil
+  acked[buf] = nil
+  dirty[buf] = nil
+end
+
+local function attach(buf)
+  if attached[buf] then
+    return true
+  end
+  local ok = vim.api.nvim_buf_attach(buf, false, {
+    on_lines = on_lines,
+    on_reload = function(_, b)
+      dirty[b] = 'reload'
+      acked[b] = nil
+    end,
+    on_detach = function(_, b)
+      attached[b] = nil
+      forget(b)
+    end,
+  })
+  attached[buf] = ok
+  return ok
+end
+
+-- The lines of the buffer for the proc: all of them until the proc has
+-- confirmed it got them, then {base, changedtick, first, last, lines}, the
+-- lines replacing [first, last) of the lines of changedtick base
+function M.lines(buf)
+  local tick = vim.api.nvim_buf_get_changedtick(buf)
+  local base = synced[buf]
+  local d = dirty[buf]
+
+  if not attach(buf) then
+    return vim.api.nvim_buf_get_lines(buf, 0, -1, false)
+  end
+
+  synced[buf] = tick
+  dirty[buf] = nil
+
+  if base == nil or d == 'reload' or acked[buf] == nil then
+    return {changedtick = tick,
+            lines = vim.api.nvim_buf_get_lines(buf, 0, -1, false)}
+  end
+
+  if d == nil then
+    d = {0, 0, 0}
+  end
+  return {base = base,
+          changedtick = tick,
+          first = d[1],
+          last = d[2],
+          lines = vim.api.nvim_buf_get_lines(buf, d[1], d[3], false)}
+end
+
+-- the proc has got all the lines of changedtick
+function M.ack(buf, changedtick)
+  if attached[buf] and synced[buf] ~= nil then
+    acked[buf] = changedtick
+  end
+end
+
+-- the proc has lost track of the buffer, send all the lines next time
+function M.resync(buf)
+  forget(buf)
+end
+
+return M
@@ -1,11 +1,166 @@
 from ncm2 import getLogger
-from os.path import dirname, join, isfile, normpath, expanduser, expandvars, basename, splitext
+from os.path import dirname, join, isfile, islink, normpath, realpath, expanduser, expandvars, basename, splitext
 from pathlib import Path
 import shlex
 import json
+import re
+import os
+import time
+import hashlib
+import sqlite3
+import sys
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from ncm2_pyclang_watcher import watcher, file_stamp
 
 logger = getLogger(__name__)
 
+_tracking = threading.local()
+
+
+@contextmanager
+def track_deps():
+    """Collect the paths of the config files that the args resolved in
+    this block depend on"""
+    deps = set()
+    prev = getattr(_tracking, 'deps', None)
+    _tracking.deps = deps
+    try:
+        yield deps
+    finally:
+        _tracking.deps = prev
+
+
+def _depend(paths):
+    deps = getattr(_tracking, 'deps', None)
+    if deps is not None:
+        deps.update(paths)
+
+
+def _lookup_failed():
+    """The args resolved in this thread are not to be memoized, the lookup
+    has failed rather than found nothing"""
+    _tracking.failed = True
+
+
+class ParsedFileCache:
+    """path -> parse(path), parsed again when the file changes. A missing
+    file is cached as None."""
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.items = {}
+        # paths parsed ahead of time, which are not watched until they are
+        # asked for
+        self.unwatched = set()
+
+    def get(self, path):
+        _depend([path])
+        item = self.items.get(path)
+        if item is not None and watcher.active and \
+                path not in self.unwatched:
+            return item[1]
+        watcher.watch(path)
+        self.unwatched.discard(path)
+        stamp = file_stamp(path)
+        if item is not None and item[0] == stamp:
+            return item[1]
+        value = None
+        if stamp is not None:
+            value = self.parse(path)
+        self.items[path] = (stamp, value)
+        return value
+
+    def prime(self, path):
+        """Parses path ahead of time, without watching it. It is checked
+        against its stamp when it is asked for."""
+        if path in self.items:
+            return
+        stamp = file_stamp(path)
+        value = None
+        if stamp is not None:
+            value = self.parse(path)
+        self.unwatched.add(path)
+        self.items[path] = (stamp, value)
+
+    def invalidate(self, path):
+        self.items.pop(path, None)
+
+
+class InternedArgs:
+    """Immutable (args, directory) pair shared by all the translation units
+    using it. Equal pairs are interned into the same object, so that cache
+    checks are an identity comparison."""
+
+    __slots__ = ['args', 'directory', '__weakref__']
+
+    def __init__(self, args, directory):
+        self.args = args
+        self.directory = directory
+
+    def __repr__(self):
+        return 'InternedArgs(dir=%s, args=%s)' % (self.directory,
+                                                 list(self.args))
+
+
+_interned_args = weakref.WeakValueDictionary()
+_interned_args_lock = threading.Lock()
+
+
+def intern_args(args, directory):
+    key = (tuple(args), directory)
+    with _interned_args_lock:
+        interned = _interned_args.get(key)
+        if interned is None:
+            args = tuple(sys.intern(arg) for arg in args)
+            interned = InternedArgs(args, directory)
+            _interned_args[(args, directory)] = interned
+    return interned
+
+
+class PathCache:
+    """Bounded LRU cache of a path transformation. Entries expire after ttl
+    seconds when ttl is given."""
+
+    def __init__(self, fn, maxsize, ttl=None):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def __call__(self, p):
+        now = time.time()
+        with self.lock:
+            item = self.items.get(p)
+            if item is not None and \
+                    (self.ttl is None or now - item[1] < self.ttl):
+                self.items.move_to_end(p)
+                return item[0]
+
+        value = self.fn(p)
+
+        with self.lock:
+            self.items[p] = (value, now)
+            self.items.move_to_end(p)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# seconds before a symlink change is noticed if the watcher misses it
+CANONICAL_PATH_TTL = 30
+
+canonical_path = PathCache(lambda p: str(Path(p).resolve()), 1024,
+                           CANONICAL_PATH_TTL)
+
 
 def _extract_args_from_cmake(filepath, cmd):
     args = None
@@ -16,54 +171,986 @@ def _extract_args_from_cmake(filepath, cmd):
     else:
         return None
 
-def args_from_cmake(filepath, cwd, database_paths):
-    filedir = dirname(filepath)
 
-    cfg_path, _ = find_config([filedir, cwd], database_paths)
+def _extract_compiler_from_cmake(cmd):
+    if 'command' in cmd:
+        return compiler_from_cmd(cmd['command'])
+    elif 'arguments' in cmd:
+        return compiler_from_cmd(cmd['arguments'])
+    else:
+        return None
 
-    if not cfg_path:
-        return None, None
+_json_ws = re.compile(r'[ \t\n\r]*')
 
-    filepath = normpath(filepath)
 
+def iter_compile_commands(f, chunk_size=1 << 16):
+    """Yield the command objects of a compile_commands.json one at a time.
+
+    Only the text of the object being decoded is kept in memory, instead of
+    the whole document as json.load would do.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    # '[' -> 'first' -> ('item' -> 'sep')*
+    expect = '['
+
+    while True:
+        pos = _json_ws.match(buf, pos).end()
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError('unexpected end of compilation database')
+            buf = f.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+
+        c = buf[pos]
+
+        if expect == '[':
+            if c != '[':
+                raise ValueError('compilation database is not a json array')
+            pos += 1
+            expect = 'first'
+            continue
+
+        if expect in ('first', 'sep'):
+            if c == ']':
+                return
+            if expect == 'sep':
+                if c != ',':
+                    raise ValueError('expecting "," at offset %s' % pos)
+                pos += 1
+                expect = 'item'
+                continue
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # the object is truncated by the chunk boundary, read more and
+            # decode it again. Grow the read size for huge objects.
+            more = f.read(max(chunk_size, len(buf) - pos))
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+
+        pos = end
+        expect = 'sep'
+        yield obj
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache')
+    d = join(base, 'ncm2_pyclang')
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def load_cache_json(name):
+    try:
+        with open(join(cache_dir(), name), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as ex:
+        logger.exception('read cache file %s failed', name)
+        return {}
+
+
+def save_cache_json(name, data):
+    p = join(cache_dir(), name)
+    fd, tmp = tempfile.mkstemp(dir=dirname(p), suffix='.tmp')
     try:
-        with open(cfg_path, "r") as f:
-            commands = json.load(f)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        # concurrent editor sessions never see a half written file
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+_cache_json_lock = threading.Lock()
+
+
+def update_cache_json(name, key, value):
+    """Sets key of the cache file, without losing the updates of other
+    threads"""
+    with _cache_json_lock:
+        data = load_cache_json(name)
+        data[key] = value
+        save_cache_json(name, data)
+
+
+def merge_fallback_args(entries):
+    """Merge the include dirs of all (args, directory, compiler) entries,
+    most used first, and the flags of the last entry. This is useful for
+    editting header files. Returns (args, compiler)."""
+    counts = {}
+    args = []
+    compiler = None
+    for args, directory, compiler in entries:
+        add_next = False
+        for arg in args:
+            if add_next:
+                add_next = False
+                inc = arg
+            elif arg == "-I":
+                add_next = True
+                continue
+            elif arg.startswith("-I"):
+                inc = arg[2:]
+            else:
+                continue
+            inc = '-I' + normpath(join(directory, inc))
+            counts[inc] = counts.get(inc, 0) + 1
+
+    # sorted() is stable, dirs used equally often keep the database order
+    all_dirs = sorted(counts.keys(), key=lambda k: counts[k], reverse=True)
+    return all_dirs + args, compiler
+
+
+class PathTrie:
+    """Source paths by directory, to find the indexed file nearest to a path
+    that is not indexed in O(depth)"""
+
+    def __init__(self, paths):
+        # node: [children, first file in the dir, first file below the dir]
+        self.root = [{}, None, None]
+        for p in paths:
+            self.insert(p)
+
+    def insert(self, path):
+        node = self.root
+        if node[2] is None:
+            node[2] = path
+        for part in path.split(os.sep)[:-1]:
+            child = node[0].get(part)
+            if child is None:
+                child = [{}, None, None]
+                node[0][part] = child
+            node = child
+            if node[2] is None:
+                node[2] = path
+        if node[1] is None:
+            node[1] = path
+
+    def nearest(self, path):
+        # the deepest directory containing every path. Files only sharing
+        # this directory are not near each other.
+        common = self.root
+        while len(common[0]) == 1 and common[1] is None:
+            common = next(iter(common[0].values()))
+
+        node = self.root
+        below_common = False
+        for part in path.split(os.sep)[:-1]:
+            child = node[0].get(part)
+            if child is None:
+                break
+            if node is common:
+                below_common = True
+            node = child
+
+        # a sibling in the same directory
+        if node[1] is not None:
+            return node[1]
+        if below_common:
+            return node[2]
+        return None
+
+
+class CompileDatabaseStore:
+    """Resolved args of a compile_commands.json, persisted with sqlite so
+    that other editor sessions don't have to parse the database again"""
+
+    # bumped whenever the schema changes
+    version = 2
+
+    def __init__(self, db_path):
+        name = hashlib.sha1(db_path.encode()).hexdigest()
+        self.db_path = db_path
+        self.path = join(cache_dir(),
+                         'cdb%s-%s.sqlite' % (self.version, name))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                     '(key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS args '
+                     '(file TEXT PRIMARY KEY, args TEXT, directory TEXT, '
+                     'compiler TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS headers '
+                     '(header TEXT PRIMARY KEY, tu TEXT)')
+        return conn
+
+    def valid(self, stamp):
+        if not isfile(self.path):
+            return False
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                               ('stamp',)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row[0] == json.dumps(stamp)
+
+    def get(self, filepath):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT args, directory, compiler FROM args '
+                               'WHERE file = ?', (filepath,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
 
-            for cmd in commands:
+    def get_header_owner(self, header):
+        if not isfile(self.path):
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT tu FROM headers WHERE header = ?',
+                               (header,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0]
+
+    def add_header_owners(self, tu, headers):
+        conn = self._connect()
+        try:
+            with conn:
+                # the first translation unit seen including a header owns it
+                conn.executemany('INSERT OR IGNORE INTO headers VALUES (?, ?)',
+                                 [(h, tu) for h in headers])
+        finally:
+            conn.close()
+
+    def files(self):
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT file FROM args')]
+        finally:
+            conn.close()
+
+    def get_fallback(self):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                               ('fallback',)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return tuple(json.loads(row[0]))
+
+    def save(self, stamp, entries):
+        start = time.time()
+        rows = []
+        resolved = []
+        for filepath, cmd in entries:
+            try:
+                args = _extract_args_from_cmake(filepath, cmd)
+                compiler = _extract_compiler_from_cmake(cmd)
+                rows.append((filepath, json.dumps(args), cmd['directory'],
+                             compiler))
+                resolved.append((args, cmd['directory'], compiler))
+            except Exception as ex:
+                logger.exception("Exception processing %s", cmd)
+        fallback = merge_fallback_args(resolved)
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM meta')
+                conn.execute('DELETE FROM args')
+                conn.executemany('INSERT INTO args VALUES (?, ?, ?, ?)', rows)
+                conn.execute('INSERT INTO meta VALUES (?, ?)',
+                             ('fallback', json.dumps(fallback)))
+                conn.execute('INSERT INTO meta VALUES (?, ?)',
+                             ('stamp', json.dumps(stamp)))
+        finally:
+            conn.close()
+
+        logger.info("compile_commands [%s] persisted to [%s], %s entries, "
+                    "time: %s", self.db_path, self.path, len(rows),
+                    time.time() - start)
+
+
+class CompileDatabase:
+
+    def __init__(self, path):
+        self.path = path
+        # the reader and the index are shared by the workers
+        self.lock = threading.RLock()
+        self.stamp = None
+        self.index = {}
+        self.complete = False
+        self.reader = None
+        # the rest of the database is being indexed in the background
+        self.finishing = False
+        self.store = CompileDatabaseStore(path)
+        self.store_valid = False
+        # header -> translation unit including it, learned from libclang
+        self.header_owners = {}
+        self.fallback = None
+        self.trie = None
+        self.changed = False
+
+    def refresh(self):
+        if islink(self.path):
+            # the watcher sees the directory of the link, not the one of its
+            # target, e.g. compile_commands.json -> build/compile_commands.json
+            target = realpath(self.path)
+            watcher.watch(target)
+            _depend([target])
+        elif watcher.active and self.stamp is not None and not self.changed:
+            return
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        watcher.watch(self.path)
+        self.changed = False
+
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return
+
+        if self.reader is not None:
+            self.reader.close()
+
+        self.index = {}
+        self.complete = False
+        self.reader = None
+        self.finishing = False
+        self.fallback = None
+        self.trie = None
+        self.stamp = stamp
+
+        try:
+            self.store_valid = self.store.valid(stamp)
+        except Exception as ex:
+            logger.exception("read [%s] failed", self.store.path)
+            self.store_valid = False
+
+    def _read(self):
+        with open(self.path, "r") as f:
+            yield from iter_compile_commands(f)
+
+    def _scan(self, until=None):
+        """Index entries until `until` is seen or the database is exhausted"""
+        if self.complete:
+            return None
+
+        start = time.time()
+
+        if self.reader is None:
+            self.reader = self._read()
+
+        index = self.index
+        for cmd in self.reader:
+            try:
+                cmd_for = normpath(join(cmd['directory'], cmd['file']))
+            except Exception as ex:
+                logger.exception("Exception processing %s", cmd)
+                continue
+            # keep the first entry, the same as a linear scan would do
+            if cmd_for not in index:
+                index[cmd_for] = cmd
+            if cmd_for == until:
+                if not self.store_valid:
+                    self._finish_scan()
+                return cmd
+
+        self.reader = None
+        self.complete = True
+
+        logger.info("compile_commands [%s] indexed, %s entries, time: %s, "
+                    "rss: %s", self.path, len(index), time.time() - start,
+                    _rss())
+
+        if not self.store_valid:
+            self.store_valid = True
+            t = threading.Thread(target=self._persist,
+                                 args=(self.stamp, list(index.items())))
+            t.daemon = True
+            t.start()
+
+        return None
+
+    def _finish_scan(self):
+        """Indexes the rest of the database in the background, so that the
+        store is written even if lookups never reach the end of it"""
+        if self.finishing:
+            return
+        self.finishing = True
+
+        def finish(stamp):
+            with self.lock:
+                if self.stamp == stamp and not self.complete:
+                    self._scan()
+
+        t = threading.Thread(target=finish, args=(self.stamp,))
+        t.daemon = True
+        t.start()
+
+    def _persist(self, stamp, entries):
+        try:
+            self.store.save(stamp, entries)
+        except Exception as ex:
+            logger.exception("write [%s] failed", self.store.path)
+
+    def lookup(self, filepath):
+        filepath = normpath(filepath)
+        cmd = self.index.get(filepath)
+        if cmd is None:
+            with self.lock:
+                cmd = self.index.get(filepath)
+                if cmd is None:
+                    cmd = self._scan(filepath)
+        return cmd
+
+    def resolve(self, filepath):
+        """Returns (args, directory, compiler) for filepath, or None"""
+        filepath = normpath(filepath)
+
+        if filepath not in self.index and not self.complete and \
+                self.store_valid:
+            try:
+                return self.store.get(filepath)
+            except Exception as ex:
+                logger.exception("read [%s] failed", self.store.path)
+
+        cmd = self.lookup(filepath)
+        if cmd is None:
+            return None
+        logger.info("compile_commands: %s", cmd)
+        return (_extract_args_from_cmake(filepath, cmd), cmd['directory'],
+                _extract_compiler_from_cmake(cmd))
+
+    def header_owner(self, header):
+        header = normpath(header)
+        if header in self.header_owners:
+            return self.header_owners[header]
+        try:
+            owner = self.store.get_header_owner(header)
+        except Exception as ex:
+            logger.exception("read [%s] failed", self.store.path)
+            owner = None
+        self.header_owners[header] = owner
+        return owner
+
+    def learn_header_owners(self, tu, headers):
+        tu = normpath(tu)
+        new = []
+        for header in headers:
+            header = normpath(header)
+            if header == tu or self.header_owners.get(header):
+                continue
+            self.header_owners[header] = tu
+            new.append(header)
+        if not new:
+            return new
+        try:
+            self.store.add_header_owners(tu, new)
+        except Exception as ex:
+            logger.exception("write [%s] failed", self.store.path)
+        logger.debug("[%s] owns %s new headers", tu, len(new))
+        return new
+
+    def _items(self):
+        with self.lock:
+            self._scan()
+            return list(self.index.items())
+
+    def files(self):
+        if self.store_valid and not self.complete:
+            try:
+                return self.store.files()
+            except Exception as ex:
+                logger.exception("read [%s] failed", self.store.path)
+        return [f for f, cmd in self._items()]
+
+    def neighbour(self, filepath):
+        """The indexed file closest to filepath"""
+        with self.lock:
+            if self.trie is None:
+                start = time.time()
+                self.trie = PathTrie(self.files())
+                logger.info("compile_commands [%s] path trie built, time: %s",
+                            self.path, time.time() - start)
+            trie = self.trie
+        return trie.nearest(normpath(filepath))
+
+    def resolve_neighbour(self, filepath):
+        neighbour = self.neighbour(filepath)
+        if neighbour is None:
+            return None
+        found = self.resolve(neighbour)
+        if found is not None:
+            logger.info("%s borrows args from neighbour %s",
+                        filepath, neighbour)
+        return found
+
+    def fallback_args(self):
+        """The (args, compiler) for files that cannot be resolved, computed
+        once for each generation of the database"""
+        with self.lock:
+            return self._fallback_args()
+
+    def _fallback_args(self):
+        if self.fallback is None and self.store_valid and not self.complete:
+            try:
+                self.fallback = self.store.get_fallback()
+            except Exception as ex:
+                logger.exception("read [%s] failed", self.store.path)
+
+        if self.fallback is None:
+            start = time.time()
+            entries = []
+            for filepath, cmd in self._items():
                 try:
-                    cmd_for = join(cmd['directory'], cmd['file'])
-                    if normpath(cmd_for) == filepath:
-                        logger.info("compile_commands: %s", cmd)
-                        args = _extract_args_from_cmake(filepath, cmd)
-                        return args, cmd['directory']
+                    args = _extract_args_from_cmake(filepath, cmd)
+                    entries.append((args, cmd['directory'],
+                                    _extract_compiler_from_cmake(cmd)))
                 except Exception as ex:
                     logger.exception("Exception processing %s", cmd)
+            self.fallback = merge_fallback_args(entries)
+            logger.info("compile_commands [%s] fallback args: %s, time: %s",
+                        self.path, len(self.fallback[0]), time.time() - start)
 
-            logger.error("Failed finding args from %s for %s", cfg_path, filepath)
+        args, compiler = self.fallback
+        return list(args), compiler
 
-            # Merge all include dirs and the flags of the last item as a
-            # fallback. This is useful for editting header file.
-            all_dirs = {}
-            for cmd in commands:
-                args = _extract_args_from_cmake(filepath, cmd)
-                add_next = False
-                for arg in args:
-                    if add_next:
-                        add_next = False
-                        all_dirs['-I' + arg] = True
-                    if arg == "-I":
-                        add_next = True
-                        continue
-                    if arg.startswith("-I"):
-                        all_dirs['-I' + arg[2:]] = True
-
-            return list(all_dirs.keys()) + args, filedir
+
+# guards _databases, _native_databases and _projects
+_databases_lock = threading.Lock()
+
+# compile_commands.json path -> CompileDatabase
+_databases = {}
+
+
+def get_compile_database(cfg_path):
+    with _databases_lock:
+        db = _databases.get(cfg_path)
+        if db is None:
+            db = CompileDatabase(cfg_path)
+            _databases[cfg_path] = db
+    db.refresh()
+    return db
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return 0
+
+
+class NativeCompileDatabase:
+    """compile_commands.json loaded and looked up by libclang itself. The
+    file list and the merged fallback are built from libclang's commands
+    too, so that the json is never loaded by python as well."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.stamp = None
+        self.cdb = None
+        self.files_ = None
+        self.trie = None
+        self.fallback = None
+        self.changed = False
+
+    def refresh(self):
+        if islink(self.path):
+            # the watcher sees the directory of the link, not the one of its
+            # target, e.g. compile_commands.json -> build/compile_commands.json
+            target = realpath(self.path)
+            watcher.watch(target)
+            _depend([target])
+        elif watcher.active and self.stamp is not None and not self.changed:
+            return
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        watcher.watch(self.path)
+        self.changed = False
+
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return
+
+        from clang import cindex
+
+        start = time.time()
+        rss = _rss()
+        # libclang looks for compile_commands.json in the directory
+        self.cdb = cindex.CompilationDatabase.fromDirectory(dirname(self.path))
+        self.stamp = stamp
+        self.files_ = None
+        self.trie = None
+        self.fallback = None
+        logger.info("native compile_commands [%s] loaded, time: %s, "
+                    "rss delta: %s", self.path, time.time() - start,
+                    _rss() - rss)
+
+    def resolve(self, filepath):
+        """Returns (args, directory, compiler) for filepath, or None"""
+        start = time.time()
+        cmds = self.cdb.getCompileCommands(filepath)
+        found = None
+        if cmds is not None:
+            for cmd in cmds:
+                arguments = list(cmd.arguments)
+                args = pick_useful_args_from_cmd(filepath, arguments)
+                found = args, cmd.directory, compiler_from_cmd(arguments)
+                break
+        logger.debug("native compile_commands lookup [%s], time: %s",
+                     filepath, time.time() - start)
+        return found
+
+    def _commands(self):
+        cmds = self.cdb.getAllCompileCommands()
+        if cmds is None:
+            return
+        for cmd in cmds:
+            yield normpath(join(cmd.directory, cmd.filename)), cmd
+
+    def files(self):
+        with self.lock:
+            if self.files_ is None:
+                start = time.time()
+                rss = _rss()
+                self.files_ = [f for f, cmd in self._commands()]
+                logger.info("native compile_commands [%s] file list: %s, "
+                            "time: %s, rss delta: %s", self.path,
+                            len(self.files_), time.time() - start,
+                            _rss() - rss)
+            return self.files_
+
+    def neighbour(self, filepath):
+        """The file of the database closest to filepath"""
+        with self.lock:
+            if self.trie is None:
+                self.trie = PathTrie(self.files())
+            trie = self.trie
+        return trie.nearest(normpath(filepath))
+
+    def resolve_neighbour(self, filepath):
+        neighbour = self.neighbour(filepath)
+        if neighbour is None:
+            return None
+        found = self.resolve(neighbour)
+        if found is not None:
+            logger.info("%s borrows args from neighbour %s",
+                        filepath, neighbour)
+        return found
+
+    def fallback_args(self):
+        with self.lock:
+            if self.fallback is None:
+                start = time.time()
+                rss = _rss()
+                entries = []
+                for filepath, cmd in self._commands():
+                    arguments = list(cmd.arguments)
+                    entries.append((pick_useful_args_from_cmd(filepath,
+                                                              arguments),
+                                    cmd.directory,
+                                    compiler_from_cmd(arguments)))
+                self.fallback = merge_fallback_args(entries)
+                logger.info("native compile_commands [%s] fallback args: "
+                            "%s, time: %s, rss delta: %s", self.path,
+                            len(self.fallback[0]), time.time() - start,
+                            _rss() - rss)
+            args, compiler = self.fallback
+        return list(args), compiler
+
+    # header owners are learned from libclang rather than read from the
+    # json, they are kept in the store of the python database
+
+    def header_owner(self, header):
+        return get_compile_database(self.path).header_owner(header)
+
+    def learn_header_owners(self, tu, headers):
+        return get_compile_database(self.path).learn_header_owners(tu,
+                                                                   headers)
+
+
+# compile_commands.json path -> NativeCompileDatabase
+_native_databases = {}
+
+
+def get_native_compile_database(cfg_path):
+    with _databases_lock:
+        db = _native_databases.get(cfg_path)
+        if db is None:
+            db = NativeCompileDatabase(cfg_path)
+            _native_databases[cfg_path] = db
+    db.refresh()
+    return db
+
+
+def get_database(cfg_path, backend):
+    if backend == 'native':
+        return get_native_compile_database(cfg_path)
+    return get_compile_database(cfg_path)
+
+
+_skip_dirs = {'node_modules'}
+
+
+class ProjectDatabases:
+    """All the compilation databases found under a project root, e.g. one
+    build directory per sub-project of a monorepo, with a merged index of
+    source path -> database"""
+
+    def __init__(self, root, database_paths, depth, backend):
+        self.root = root
+        self.names = {basename(p) for p in database_paths}
+        self.depth = depth
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.paths = None
+        self.stamps = None
+        self.index = {}
+        self.trie = None
+
+    def discover(self):
+        start = time.time()
+        paths = []
+        root_depth = self.root.rstrip(os.sep).count(os.sep)
+        for d, dirs, files in os.walk(self.root):
+            if d.rstrip(os.sep).count(os.sep) - root_depth >= self.depth:
+                dirs[:] = []
+            else:
+                dirs[:] = [e for e in dirs
+                           if not e.startswith('.') and e not in _skip_dirs]
+            for name in files:
+                if name in self.names:
+                    paths.append(join(d, name))
+        paths.sort()
+        logger.info("project [%s] databases: %s, time: %s",
+                    self.root, paths, time.time() - start)
+        return paths
+
+    def databases(self):
+        with self.lock:
+            return self._databases()
+
+    def _databases(self):
+        if self.paths is None:
+            self.paths = self.discover()
+
+        dbs = []
+        for p in self.paths:
+            try:
+                dbs.append(get_database(p, self.backend))
+            except Exception as ex:
+                logger.exception("read compile_commands.json [%s] failed.", p)
+                _lookup_failed()
+        _depend(self.paths)
+
+        stamps = [(db.path, db.stamp) for db in dbs]
+        if stamps != self.stamps:
+            start = time.time()
+            index = {}
+            for db in dbs:
+                for f in db.files():
+                    index.setdefault(f, db)
+            self.index = index
+            self.trie = PathTrie(index.keys())
+            self.stamps = stamps
+            logger.info("project [%s] merged index: %s files, time: %s",
+                        self.root, len(index), time.time() - start)
+        return dbs
+
+    def resolve(self, filepath):
+        filepath = normpath(filepath)
+        dbs = self.databases()
+
+        db = self.index.get(filepath)
+        if db is not None:
+            return db.resolve(filepath)
+
+        for db in dbs:
+            owner = db.header_owner(filepath)
+            if owner is None:
+                continue
+            found = db.resolve(owner)
+            if found is not None:
+                logger.info("%s borrows args from %s", filepath, owner)
+                return found
+
+        return None
+
+    def resolve_neighbour(self, filepath):
+        filepath = normpath(filepath)
+        self.databases()
+        neighbour = self.trie.nearest(filepath)
+        if neighbour is None:
+            return None
+        found = self.index[neighbour].resolve(neighbour)
+        if found is not None:
+            logger.info("%s borrows args from neighbour %s",
+                        filepath, neighbour)
+        return found
+
+    def find(self, filepath):
+        """The database containing filepath"""
+        self.databases()
+        return self.index.get(normpath(filepath))
+
+
+# (root, database names, depth, backend) -> ProjectDatabases
+_projects = {}
+
+
+def get_project_databases(root, database_paths, depth, backend='python'):
+    key = (root, tuple(database_paths), depth, backend)
+    with _databases_lock:
+        project = _projects.get(key)
+        if project is None:
+            project = ProjectDatabases(root, database_paths, depth, backend)
+            _projects[key] = project
+    return project
+
+
+def _resolve_in_project(filepath, cwd, database_paths, discover_depth,
+                        backend, neighbour=False):
+    if discover_depth <= 0:
+        return None
+    root = normpath(cwd)
+    if not filepath.startswith(join(root, '')):
+        return None
+    try:
+        project = get_project_databases(root, database_paths, discover_depth,
+                                        backend)
+        if neighbour:
+            return project.resolve_neighbour(filepath)
+        return project.resolve(filepath)
+    except Exception as ex:
+        logger.exception("resolve [%s] in project [%s] failed.",
+                         filepath, root)
+        _lookup_failed()
+    return None
+
+
+def args_from_cmake(filepath, cwd, database_paths, discover_depth=0,
+                    backend='python'):
+    filedir = dirname(filepath)
+
+    cfg_path, _ = find_config([filedir, cwd], database_paths)
+
+    filepath = normpath(filepath)
+
+    if not cfg_path:
+        found = _resolve_in_project(filepath, cwd, database_paths,
+                                    discover_depth, backend)
+        if found is None:
+            found = _resolve_in_project(filepath, cwd, database_paths,
+                                        discover_depth, backend,
+                                        neighbour=True)
+        if found is not None:
+            return found
+        return None, None, None
+
+    try:
+        db = get_database(cfg_path, backend)
+
+        found = db.resolve(filepath)
+        if found is not None:
+            return found
+
+        # header files are not in the database, reuse the flags of the
+        # translation unit that includes it
+        owner = db.header_owner(filepath)
+        if owner is not None:
+            found = db.resolve(owner)
+            if found is not None:
+                logger.info("%s borrows args from %s", filepath, owner)
+                return found
+
+        # in a monorepo, the file may belong to the build of another
+        # sub-project
+        found = _resolve_in_project(filepath, cwd, database_paths,
+                                    discover_depth, backend)
+        if found is not None:
+            return found
+
+        # new or generated files, borrow the args of the closest file, which
+        # are much smaller than the merged fallback
+        found = db.resolve_neighbour(filepath)
+        if found is not None:
+            return found
+
+        found = _resolve_in_project(filepath, cwd, database_paths,
+                                    discover_depth, backend, neighbour=True)
+        if found is not None:
+            return found
+
+        logger.error("Failed finding args from %s for %s", cfg_path, filepath)
+
+        args, compiler = db.fallback_args()
+        return args, filedir, compiler
 
     except Exception as ex:
         logger.exception("read compile_commands.json [%s] failed.", cfg_path)
+        _lookup_failed()
+
+    return None, None, None
+
+
+def learn_header_owners(filepath, cwd, database_paths, headers,
+                        discover_depth=0, backend='python'):
+    """Remember the headers included by filepath so that they are parsed
+    with the args of filepath later. Returns the headers newly learned."""
+    cfg_path, _ = find_config([dirname(filepath), cwd], database_paths)
+
+    try:
+        db = None
+        if cfg_path:
+            db = get_database(cfg_path, backend)
+            if db.resolve(filepath) is None:
+                db = None
+
+        root = normpath(cwd)
+        if db is None and discover_depth > 0 and \
+                filepath.startswith(join(root, '')):
+            project = get_project_databases(root, database_paths,
+                                            discover_depth, backend)
+            db = project.find(filepath)
+
+        if db is None:
+            return []
+        return db.learn_header_owners(filepath, headers)
+    except Exception as ex:
+        logger.exception("learn header owners for [%s] failed.", filepath)
+
+    return []
+
 
-    return None, None
+def _parse_clang_complete(clang_complete):
+    with open(clang_complete, "r") as f:
+        cmd = shlex.split(" ".join(f.readlines()))
+        return [expanduser(expandvars(p)) for p in cmd]
+
+
+_clang_complete_files = ParsedFileCache(_parse_clang_complete)
 
 
 def args_from_clang_complete(filepath, cwd, args_file_path):
@@ -72,22 +1159,131 @@ def args_from_clang_complete(filepath, cwd, args_file_path):
     clang_complete, directory = find_config([filedir, cwd], args_file_path)
 
     if not clang_complete:
-        return None, None
+        return None, None, None
 
     try:
-        with open(clang_complete, "r") as f:
-            cmd = shlex.split(" ".join(f.readlines()))
-
-            cmd = [expanduser(expandvars(p)) for p in cmd]
+        cmd = _clang_complete_files.get(clang_complete)
+        if cmd is None:
+            return None, None, None
 
-            args = pick_useful_args_from_cmd(filepath, cmd)
+        args = pick_useful_args_from_cmd(filepath, cmd)
 
-            logger.info('.clang_complete args: [%s] cmd[%s]', args, cmd)
-            return args, directory
+        logger.info('.clang_complete args: [%s] cmd[%s]', args, cmd)
+        return args, directory, None
     except Exception as ex:
         logger.exception('read config file %s failed.', clang_complete)
 
-    return None, None
+    return None, None, None
+
+def _parse_compile_flags(flags_file):
+    with open(flags_file, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+_compile_flags_files = ParsedFileCache(_parse_compile_flags)
+
+
+# compile_flags.txt, as used by clangd, has one argument per line
+def args_from_compile_flags(filepath, cwd, flags_file_path):
+    filedir = dirname(filepath)
+
+    flags_file, _ = find_config([filedir, cwd], flags_file_path)
+
+    if not flags_file:
+        return None, None, None
+
+    try:
+        cmd = _compile_flags_files.get(flags_file)
+        if cmd is None:
+            return None, None, None
+
+        args = pick_useful_args_from_cmd(filepath, cmd)
+
+        logger.info('compile_flags.txt args: [%s]', args)
+        # relative paths are relative to the directory of the file
+        return args, dirname(flags_file), None
+    except Exception as ex:
+        logger.exception('read config file %s failed.', flags_file)
+
+    return None, None, None
+
+# .cmd files are mostly the dependency list of the object, the command line
+# is at the top
+KBUILD_CMD_READ_LIMIT = 1 << 16
+
+_kbuild_cmd_pat = re.compile(r'^\..*\.o\.cmd$')
+
+
+def _parse_kbuild_cmd(dot_cmd):
+    left = KBUILD_CMD_READ_LIMIT
+    with open(dot_cmd, errors='replace') as dot_f:
+        while left > 0:
+            line = dot_f.readline(left)
+            if not line:
+                break
+            left -= len(line)
+            if not line.endswith('\n') and left <= 0:
+                # truncated
+                break
+
+            # newer kernels write savedcmd_init/main.o
+            if line.startswith('cmd_'):
+                prefix = 'cmd_'
+            elif line.startswith('savedcmd_'):
+                prefix = 'savedcmd_'
+            else:
+                continue
+
+            idx = line.find(':=')
+            if idx == -1:
+                continue
+
+            # cmd_init/main.o
+            obj = line[len(prefix) : idx].strip()
+            cmd = line[idx + 2:].rstrip('\n')
+            args = pick_useful_args_from_cmd(dot_cmd, cmd)
+            # the files of a tree share most of their args, and a whole
+            # tree may be primed
+            return obj, intern_args(args, ''), compiler_from_cmd(cmd)
+
+    return None, None, None
+
+
+_kbuild_cmd_files = ParsedFileCache(_parse_kbuild_cmd)
+
+# kbuild trees indexed or being indexed in the background
+_kbuild_trees = set()
+
+
+def _index_kbuild_tree(root):
+    start = time.time()
+    count = 0
+    for d, dirs, files in os.walk(root):
+        dirs[:] = [e for e in dirs
+                   if not e.startswith('.') and e not in _skip_dirs]
+        for name in files:
+            if not _kbuild_cmd_pat.match(name):
+                continue
+            dot_cmd = join(d, name)
+            if dot_cmd in _kbuild_cmd_files.items:
+                continue
+            try:
+                _kbuild_cmd_files.prime(dot_cmd)
+                count += 1
+            except Exception as ex:
+                logger.exception('read %s failed', dot_cmd)
+    logger.info('kbuild tree [%s] indexed, %s .cmd files, time: %s',
+                root, count, time.time() - start)
+
+
+def index_kbuild_tree(root):
+    if root in _kbuild_trees:
+        return
+    _kbuild_trees.add(root)
+    t = threading.Thread(target=_index_kbuild_tree, args=(root,))
+    t.daemon = True
+    t.start()
+
 
 # linux kernel build init/main.o -> init/.main.o.cmd:
 #
@@ -99,40 +1295,51 @@ def args_from_kbuild(filepath, cwd):
 
     dot_cmd = join(filedir, '.' + nameroot + '.o.cmd')
 
-    if not isfile(dot_cmd):
+    parsed = _kbuild_cmd_files.get(dot_cmd)
+    if parsed is None:
         logger.debug('args_from_kbuild dot_cmd not found: %s', dot_cmd)
-        return None, None
+        return None, None, None
 
-    with open(dot_cmd) as dot_f:
-        while True:
-            line = dot_f.readline()
-            if line is None:
-                break
+    obj, args, compiler = parsed
+    if obj is not None:
+        args = list(args.args)
 
-            if not line.startswith('cmd_'):
-                continue
+        objdir = dirname(obj)
+        if filedir.endswith(objdir):
+            directory = filedir[0: len(filedir) - len(objdir)]
+            logger.debug('args_from_kbuild [%s] found, args: %s, dir: %s', dot_cmd, args, directory)
+            # the rest of the tree is likely to be opened too. Only a root
+            # confirmed by the object path is indexed, cwd may be $HOME.
+            index_kbuild_tree(normpath(directory))
+        else:
+            directory = cwd
+            logger.debug('args_from_kbuild [%s] found, args: %s, cwd dir: %s, objdir: %s', dot_cmd, args, directory, objdir)
 
-            idx = line.find(':=')
-            if idx == -1:
-                continue
+        return args, directory, compiler
 
-            args = pick_useful_args_from_cmd(filepath, line[idx + 2:])
+    logger.debug('args_from_kbuild dot_cmd found, but no result: %s', dot_cmd)
 
-            # cmd_init/main.o
-            obj = line[len('cmd_') : idx].strip()
-            objdir = dirname(obj)
-            if filedir.endswith(objdir):
-                directory = filedir[0: len(filedir) - len(objdir)]
-                logger.debug('args_from_kbuild [%s] found, args: %s, dir: %s', dot_cmd, args, directory)
-            else:
-                directory = cwd
-                logger.debug('args_from_kbuild [%s] found, args: %s, cwd dir: %s, objdir: %s', dot_cmd, args, directory, objdir)
-            
-            return args, directory
+    return None, None, None
 
-    logger.debug('args_from_kbuild dot_cmd found, but no result: %s', dot_cmd)
+_compiler_wrappers = {'ccache', 'distcc', 'sccache', 'icecc'}
+
+
+def compiler_from_cmd(cmd):
+    """The compiler of a command line, i.e. the leading token that
+    pick_useful_args_from_cmd drops, skipping compiler wrappers"""
+    if type(cmd) is str:
+        # only the head of the command is needed
+        lexer = shlex.shlex(cmd, posix=True)
+        lexer.whitespace_split = True
+        cmd = lexer
+    for token in cmd:
+        if token.startswith('-'):
+            return None
+        if basename(token) in _compiler_wrappers:
+            continue
+        return token
+    return None
 
-    return None, None
 
 # FIXME this is not an exact argument parsing implementation, but it is the
 # easiest implementation for now
@@ -191,21 +1398,276 @@ def pick_useful_args_from_cmd(filepath, cmd):
     return args
 
 
-def find_config(bases, names):
-    if isinstance(names, str):
-        names = [names]
+# (bases, names) -> [(path, dir), [(searched dir, mtime)], last validated,
+#                    paths checked]
+_config_memo = {}
+
+# seconds a find_config result is trusted without looking at the disk, when
+# the file watcher is not running
+FIND_CONFIG_TTL = 1.0
+
+
+def _dir_stamp(d):
+    try:
+        return os.stat(d).st_mtime_ns
+    except OSError:
+        return None
 
-    if isinstance(bases, str):
-        bases = [bases]
 
+def _search_config(bases, names):
+    stamps = []
+    paths = []
     for base in bases:
-        r = Path(base).resolve()
+        r = Path(canonical_path(base))
         dirs = [r] + list(r.parents)
         for d in dirs:
             d = str(d)
+            # a config file appearing or disappearing changes the mtime of
+            # the directory containing it. Take the stamps before checking
+            # the files so that no change is missed.
+            for sub in {dirname(join(d, name)) for name in names}:
+                stamps.append((sub, _dir_stamp(sub)))
             for name in names:
                 p = join(d, name)
+                watcher.watch(p)
+                paths.append(p)
                 if isfile(p):
-                    return p, d
+                    return (p, d), stamps, paths
+
+    return (None, None), stamps, paths
+
+
+def find_config(bases, names):
+    if isinstance(names, str):
+        names = [names]
+
+    if isinstance(bases, str):
+        bases = [bases]
+
+    key = (tuple(bases), tuple(names))
+    now = time.time()
+
+    memo = _config_memo.get(key)
+    if memo is not None:
+        result, stamps, checked, paths = memo
+        if watcher.active or now - checked < FIND_CONFIG_TTL:
+            _depend(paths)
+            return result
+        if all(_dir_stamp(d) == stamp for d, stamp in stamps):
+            memo[2] = now
+            _depend(paths)
+            return result
+
+    result, stamps, paths = _search_config(bases, names)
+    _config_memo[key] = [result, stamps, now, set(paths)]
+    _depend(paths)
+    return result
+
+
+def _on_file_changed(path):
+    # a build tree may have been relinked
+    canonical_path.clear()
+
+    for key, memo in list(_config_memo.items()):
+        if path in memo[3]:
+            _config_memo.pop(key, None)
+
+    db = _databases.get(path)
+    if db is not None:
+        db.changed = True
+
+    db = _native_databases.get(path)
+    if db is not None:
+        db.changed = True
+
+    _clang_complete_files.invalidate(path)
+    _compile_flags_files.invalidate(path)
+    _kbuild_cmd_files.invalidate(path)
+
+
+watcher.add_listener(_on_file_changed)
+
+
+class FlagProvider:
+    """A source of compile args in a FlagPipeline. Results, including
+    misses, are memoized per buffer until a file they were resolved from
+    changes."""
+
+    name = ''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # buffer key -> [(args, directory, compiler), deps, resolved time]
+        self.memo = {}
+        self.generation = 0
+        self.lookups = 0
+        self.cache_hits = 0
+        self.found = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def key(self, filepath, cwd, data):
+        return filepath, cwd
+
+    def lookup(self, filepath, cwd, data):
+        raise NotImplementedError
+
+    def resolve(self, filepath, cwd, data):
+        start = time.time()
+        key = self.key(filepath, cwd, data)
+
+        memo = self.memo.get(key)
+        hit = memo is not None and \
+            (watcher.active or start - memo[2] < FIND_CONFIG_TTL)
+
+        if hit:
+            result, deps = memo[0], memo[1]
+        else:
+            generation = self.generation
+            _tracking.failed = False
+            with track_deps() as deps:
+                try:
+                    args, directory, compiler = self.lookup(filepath, cwd,
+                                                            data)
+                except Exception as ex:
+                    logger.exception('%s lookup for %s failed',
+                                     self.name, filepath)
+                    _lookup_failed()
+                    args, directory, compiler = None, None, None
+            failed = _tracking.failed
+            if args is not None:
+                args = tuple(args)
+            result = (args, directory, compiler)
+            # don't memoize a result that may have been invalidated while
+            # resolving it, nor a failure, which is retried next time
+            with self.lock:
+                if generation == self.generation and not failed:
+                    self.memo[key] = [result, deps, start]
+
+        _depend(deps)
+
+        elapsed = time.time() - start
+        with self.lock:
+            self.lookups += 1
+            self.cache_hits += hit
+            self.found += result[0] is not None
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+        args, directory, compiler = result
+        if args is None:
+            return None, None, None
+        return list(args), directory, compiler
+
+    def invalidate(self, path):
+        with self.lock:
+            self.generation += 1
+            for key, memo in list(self.memo.items()):
+                if path in memo[1]:
+                    del self.memo[key]
+
+    def forget(self, filepaths):
+        with self.lock:
+            self.generation += 1
+            for key in list(self.memo.keys()):
+                if key[0] in filepaths:
+                    del self.memo[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = max(self.lookups, 1)
+            return dict(name=self.name,
+                        lookups=self.lookups,
+                        cache_hits=self.cache_hits,
+                        cache_hit_rate=self.cache_hits / lookups,
+                        found=self.found,
+                        found_rate=self.found / lookups,
+                        avg_ms=self.total_time * 1000 / lookups,
+                        max_ms=self.max_time * 1000)
+
+
+# name -> FlagProvider subclass
+flag_providers = {}
+
+
+def register_flag_provider(cls):
+    flag_providers[cls.name] = cls
+    return cls
+
+
+@register_flag_provider
+class CMakeProvider(FlagProvider):
+    name = 'cmake'
+
+    def key(self, filepath, cwd, data):
+        return (filepath, cwd, tuple(data['database_path']),
+                data['database_discover_depth'], data['database_backend'])
+
+    def lookup(self, filepath, cwd, data):
+        return args_from_cmake(filepath, cwd, data['database_path'],
+                               data['database_discover_depth'],
+                               data['database_backend'])
+
+
+@register_flag_provider
+class KbuildProvider(FlagProvider):
+    name = 'kbuild'
+
+    def lookup(self, filepath, cwd, data):
+        return args_from_kbuild(filepath, cwd)
+
+
+@register_flag_provider
+class CompileFlagsProvider(FlagProvider):
+    name = 'compile_flags'
+
+    def key(self, filepath, cwd, data):
+        return filepath, cwd, tuple(data['flags_file_path'])
+
+    def lookup(self, filepath, cwd, data):
+        return args_from_compile_flags(filepath, cwd, data['flags_file_path'])
+
+
+@register_flag_provider
+class ClangCompleteProvider(FlagProvider):
+    name = 'clang_complete'
+
+    def key(self, filepath, cwd, data):
+        return filepath, cwd, tuple(data['args_file_path'])
+
+    def lookup(self, filepath, cwd, data):
+        return args_from_clang_complete(filepath, cwd, data['args_file_path'])
+
+
+class FlagPipeline:
+    """Asks the providers, in order, for the compile args of a file"""
+
+    def __init__(self, names):
+        self.providers = []
+        for name in names:
+            cls = flag_providers.get(name)
+            if cls is None:
+                logger.error('unknown flag provider %s', name)
+                continue
+            self.providers.append(cls())
+        watcher.add_listener(self.on_file_changed)
+
+    def resolve(self, filepath, cwd, data):
+        """Returns (args, directory, compiler, provider name)"""
+        for provider in self.providers:
+            args, directory, compiler = provider.resolve(filepath, cwd, data)
+            if args is not None:
+                return args, directory, compiler, provider.name
+        return None, None, None, None
+
+    def on_file_changed(self, path):
+        for provider in self.providers:
+            provider.invalidate(path)
+
+    def forget(self, filepaths):
+        filepaths = set(filepaths)
+        for provider in self.providers:
+            provider.forget(filepaths)
 
-    return None, None
+    def stats(self):
+        return [provider.stats() for provider in self.providers]
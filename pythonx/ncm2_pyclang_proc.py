@@ -5,21 +5,31 @@ import subprocess
 import re
 from os.path import dirname
 from os import path, scandir
+import os
 import vim
 import json
 import shlex
 import time
 import threading
-import queue
 import traceback
+import itertools
+import fnmatch
+import heapq
+from collections import OrderedDict, deque
+from concurrent.futures import Future, CancelledError, \
+    TimeoutError as FutureTimeoutError
 from distutils.spawn import find_executable
 
 import sys
 sys.path.insert(0, path.join(dirname(__file__), '3rd'))
 
-from ncm2_pyclang import args_from_cmake, args_from_clang_complete, args_from_kbuild
+from ncm2_pyclang import FlagPipeline, learn_header_owners, track_deps, \
+    intern_args, load_cache_json, update_cache_json
+from ncm2_pyclang_watcher import watcher
+from ncm2_pyclang_worker import tu_memory_usage, tu_includes, declaration_at, \
+    parse_flags, send_msg, recv_msg, SerializedResult
 from clang import cindex
-from clang.cindex import CodeCompletionResult, CompletionString, SourceLocation, Cursor, File, Diagnostic
+from clang.cindex import CompletionString
 
 logger = getLogger(__name__)
 
@@ -28,6 +38,593 @@ class ErrTaskCancel(Exception):
     pass
 
 
+class ErrWorkerCrash(Exception):
+    pass
+
+
+class ErrMissingTU(Exception):
+    pass
+
+
+class TUBudget:
+    """Least recently used order of the translation units of all the
+    TUCaches sharing it. The oldest ones are evicted when there are more than
+    max_count of them or they use more than max_memory bytes, 0 means no
+    limit."""
+
+    def __init__(self, max_count, max_memory):
+        # the caches are used by all the workers, an RLock because evicting
+        # from a cache discards from the budget
+        self.lock = threading.RLock()
+        self.max_count = max_count
+        self.max_memory = max_memory
+        # (cache, filepath) -> bytes used
+        self.lru = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_memory = 0
+
+    def touch(self, cache, filepath, memory=None):
+        key = (cache, filepath)
+        with self.lock:
+            if memory is None:
+                memory = self.lru.get(key, 0)
+            self.memory += memory - self.lru.pop(key, 0)
+            self.lru[key] = memory
+            self.shrink(key)
+
+    def discard(self, cache, filepath):
+        with self.lock:
+            self.memory -= self.lru.pop((cache, filepath), 0)
+
+    def over_budget(self):
+        if self.max_count and len(self.lru) > self.max_count:
+            return True
+        return bool(self.max_memory) and self.memory > self.max_memory
+
+    def shrink(self, keep):
+        # never evict the tu that is being used
+        while len(self.lru) > 1 and self.over_budget():
+            key, memory = next(iter(self.lru.items()))
+            if key == keep:
+                break
+            cache, filepath = key
+            cache.evict(filepath)
+            self.evictions += 1
+            self.evicted_memory += memory
+            logger.info('%s tu %s evicted, %s MB, %s tus / %s MB left',
+                        cache.name, filepath, memory >> 20, len(self.lru),
+                        self.memory >> 20)
+
+    def stats(self):
+        with self.lock:
+            return self._stats()
+
+    def _stats(self):
+        return dict(count=len(self.lru),
+                    memory=self.memory,
+                    max_count=self.max_count,
+                    max_memory=self.max_memory,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    evicted_memory=self.evicted_memory,
+                    tus=[dict(kind=c.name, filepath=f, memory=m)
+                         for (c, f), m in self.lru.items()])
+
+
+class Timings:
+    """Latency of the libclang calls, by name"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> [count, total, max]
+        self.timings = {}
+
+    def add(self, name, elapsed):
+        with self.lock:
+            t = self.timings.setdefault(name, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += elapsed
+            t[2] = max(t[2], elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(count=count,
+                               avg_ms=total * 1000 / count,
+                               max_ms=max_time * 1000)
+                    for name, (count, total, max_time)
+                    in self.timings.items()}
+
+
+class BufferMirror:
+    """The lines of the buffers as last sent by vim. Neovim sends only the
+    lines changed since its previous request, see lua/ncm2_pyclang.lua"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # bufnr -> [changedtick, lines], several buffers may share a path,
+        # e.g. unnamed ones
+        self.buffers = {}
+        self.full = 0
+        self.deltas = 0
+        self.delta_lines = 0
+        self.mismatches = 0
+
+    def update(self, bufnr, lines):
+        """Returns all the lines of the buffer, or None if the delta doesn't
+        apply to the lines we have and the buffer needs to be resent"""
+        if isinstance(lines, list):
+            # plain vim
+            return lines
+
+        with self.lock:
+            if 'base' not in lines:
+                self.full += 1
+                self.buffers[bufnr] = [lines['changedtick'],
+                                          lines['lines']]
+                return lines['lines']
+
+            cur = self.buffers.get(bufnr)
+            if cur is None or cur[0] != lines['base']:
+                self.mismatches += 1
+                self.buffers.pop(bufnr, None)
+                return None
+
+            self.deltas += 1
+            self.delta_lines += len(lines['lines'])
+            # a new list, the old one may still be used by a queued task
+            old = cur[1]
+            new = old[:lines['first']] + lines['lines'] + old[lines['last']:]
+            self.buffers[bufnr] = [lines['changedtick'], new]
+            return new
+
+    def discard(self, bufnr):
+        with self.lock:
+            self.buffers.pop(bufnr, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(buffers=len(self.buffers),
+                        full=self.full,
+                        deltas=self.deltas,
+                        delta_lines=self.delta_lines,
+                        mismatches=self.mismatches)
+
+
+class TUCache:
+    """filepath -> cache item, with the translation units bounded by a
+    TUBudget"""
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.items_ = {}
+
+    def __contains__(self, filepath):
+        return filepath in self.items_
+
+    def __getitem__(self, filepath):
+        return self.items_[filepath]
+
+    def __setitem__(self, filepath, item):
+        with self.budget.lock:
+            self.items_[filepath] = item
+            self.measure(filepath)
+
+    def __delitem__(self, filepath):
+        with self.budget.lock:
+            del self.items_[filepath]
+            self.budget.discard(self, filepath)
+
+    def pop(self, filepath, default=None):
+        """Removes the item, unless another worker has evicted it already"""
+        with self.budget.lock:
+            item = self.items_.pop(filepath, None)
+            if item is None:
+                return default
+            self.budget.discard(self, filepath)
+            return item
+
+    def items(self):
+        with self.budget.lock:
+            return list(self.items_.items())
+
+    def lookup(self, filepath):
+        with self.budget.lock:
+            item = self.items_.get(filepath)
+            if item is None:
+                self.budget.misses += 1
+            else:
+                self.budget.hits += 1
+            return item
+
+    def measure(self, filepath):
+        """Updates the memory used by the tu, e.g. after it is reparsed,
+        and marks it as the most recently used"""
+        with self.budget.lock:
+            item = self.items_.get(filepath)
+            if item is None:
+                # evicted by another worker
+                return
+            try:
+                memory = tu_memory(item['tu'])
+            except Exception as ex:
+                logger.exception('get resource usage of %s failed', filepath)
+                memory = None
+            self.budget.touch(self, filepath, memory)
+
+    def evict(self, filepath):
+        with self.budget.lock:
+            item = self.items_.pop(filepath)
+            self.budget.discard(self, filepath)
+        # the tu is disposed as soon as the last reference is dropped, i.e.
+        # right away unless a worker is still using it
+        item.pop('tu', None)
+
+
+# a worker process that crashes that many times in a row right after it
+# starts, e.g. because it cannot load libclang, is not restarted anymore
+MAX_STARTUP_CRASHES = 5
+
+
+class WorkerProcess:
+    """A ncm2_pyclang_worker process holding translation units, restarted
+    when it crashes"""
+
+    def __init__(self, wid, library_path, on_restart, on_give_up):
+        self.wid = wid
+        self.library_path = library_path
+        self.on_restart = on_restart
+        self.on_give_up = on_give_up
+        self.lock = threading.Lock()
+        # bumped on restart, the tus of older generations are gone
+        self.generation = 0
+        self.restarts = 0
+        # ids of the released tus, disposed with the next request
+        self.released = deque()
+        self.start()
+        t = threading.Thread(target=self.supervise)
+        t.daemon = True
+        t.start()
+
+    def start(self):
+        script = path.join(dirname(__file__), 'ncm2_pyclang_worker.py')
+        self.proc = Popen(args=[sys.executable, script, self.library_path],
+                          stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE)
+        self.started = time.time()
+        logger.info('worker process %s started, pid %s',
+                    self.wid, self.proc.pid)
+
+    def supervise(self):
+        startup_crashes = 0
+        while True:
+            proc = self.proc
+            code = proc.wait()
+            logger.error('worker process %s (pid %s) exited with %s',
+                         self.wid, proc.pid, code)
+            if time.time() - self.started < 1:
+                startup_crashes += 1
+                if startup_crashes >= MAX_STARTUP_CRASHES:
+                    logger.error('worker process %s keeps crashing on '
+                                 'startup, giving up', self.wid)
+                    with self.lock:
+                        self.generation += 1
+                        self.released.clear()
+                    self.on_give_up(self)
+                    return
+                # don't spin if it crashes on startup
+                time.sleep(1)
+            else:
+                startup_crashes = 0
+            with self.lock:
+                self.generation += 1
+                self.restarts += 1
+                self.released.clear()
+                self.start()
+            self.on_restart(self)
+
+    def release(self, tu_id, generation):
+        if generation == self.generation:
+            self.released.append(tu_id)
+
+    def call(self, method, **params):
+        with self.lock:
+            released = []
+            while self.released:
+                released.append(self.released.popleft())
+            msg = dict(method=method, params=params, dispose=released)
+            try:
+                send_msg(self.proc.stdin, msg)
+                reply = recv_msg(self.proc.stdout)
+            except (OSError, EOFError, ValueError) as ex:
+                raise ErrWorkerCrash('worker process %s: %s' % (self.wid, ex))
+
+        error = reply.get('error')
+        if error == 'missing':
+            raise ErrMissingTU(reply['message'])
+        if error is not None:
+            raise Exception('worker process %s %s failed: %s' %
+                            (self.wid, method, reply['message']))
+        return reply['result']
+
+    def stats(self):
+        return dict(pid=self.proc.pid, restarts=self.restarts)
+
+
+class RemoteCompletionResults:
+
+    def __init__(self, results):
+        self.results = results
+
+
+class RemoteTU:
+    """A translation unit living in a worker process. It is parsed again
+    from the last source it has seen when the process has been restarted."""
+
+    ids = itertools.count(1)
+
+    def __init__(self, process, kind, filepath, args, directory, src):
+        self.process = process
+        self.kind = kind
+        self.filepath = filepath
+        self.args = list(args)
+        self.directory = directory
+        self.tu_id = None
+        self.generation = None
+        self.src = None
+        self.memory = 0
+        self.includes = []
+        self.parse(src)
+
+    def __del__(self):
+        if self.tu_id is not None:
+            self.process.release(self.tu_id, self.generation)
+
+    def parse(self, src):
+        if self.tu_id is not None:
+            self.process.release(self.tu_id, self.generation)
+            self.tu_id = None
+        generation = self.process.generation
+        tu_id = next(RemoteTU.ids)
+        result = self.process.call('parse', tu_id=tu_id, kind=self.kind,
+                                   filepath=self.filepath, args=self.args,
+                                   directory=self.directory, src=src)
+        self.tu_id, self.generation = tu_id, generation
+        # the source that has been parsed successfully, not the one that may
+        # have crashed the process
+        self.src = src
+        self.memory = result['memory']
+        self.includes = result['includes']
+
+    def ensure(self):
+        if self.generation != self.process.generation:
+            logger.info('rehydrate %s tu %s in worker process %s',
+                        self.kind, self.filepath, self.process.wid)
+            self.parse(self.src)
+            return True
+        return False
+
+    def reparse(self, unsaved_files):
+        filepath, src = unsaved_files[0]
+        if self.ensure() and src == self.src:
+            return
+        try:
+            result = self.process.call('reparse', tu_id=self.tu_id,
+                                       filepath=filepath, src=src)
+            self.src = src
+            self.memory = result['memory']
+        except ErrMissingTU:
+            self.parse(src)
+
+    def codeComplete(self, filepath, lnum, bcol, unsaved_files, **kwargs):
+        self.ensure()
+        src = unsaved_files[0][1]
+        results = self.process.call('complete', tu_id=self.tu_id,
+                                    filepath=filepath, src=src,
+                                    lnum=lnum, bcol=bcol)
+        return RemoteCompletionResults([SerializedResult(r) for r in results])
+
+    def declaration(self, filepath, lnum, bcol):
+        self.ensure()
+        return self.process.call('declaration', tu_id=self.tu_id,
+                                 filepath=filepath, lnum=lnum, bcol=bcol)
+
+
+def tu_memory(tu):
+    if isinstance(tu, RemoteTU):
+        return tu.memory
+    return tu_memory_usage(tu)
+
+
+PRIORITY_COMPLETION = 0
+PRIORITY_GOTO = 1
+PRIORITY_WARMUP = 2
+PRIORITY_BACKGROUND = 3
+
+
+class TaskQueue:
+    """Tasks of a worker, by priority. The tasks of a file still run in the
+    order they are queued: queuing a task raises the queued tasks of its file
+    to its priority. A task with a key replaces the queued task with the same
+    key, and the oldest warmup tasks are dropped when there are more than
+    max_warmups of them."""
+
+    # entry fields
+    PRIORITY, SEQ, NAME, FILEPATH, KEY, TASK, ORIGIN, ALIVE = range(8)
+
+    def __init__(self, max_warmups):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        # filepath -> queued entries, in order
+        self.files = {}
+        # key -> queued entry
+        self.keys = {}
+        self.unfinished = 0
+        self.max_warmups = max_warmups
+        self.coalesced = 0
+        self.shed = 0
+        self.boosted = 0
+
+    def put(self, name, task, priority, filepath=None, key=None):
+        """Returns True if a queued task has been replaced"""
+        replaced = False
+        with self.cond:
+            if key is not None and key in self.keys:
+                self._remove(self.keys[key])
+                self.coalesced += 1
+                replaced = True
+
+            entry = [priority, next(self.seq), name, filepath, key, task,
+                     priority, True]
+
+            if filepath is not None:
+                entries = self.files.setdefault(filepath, [])
+                for i, e in enumerate(entries):
+                    if e[self.PRIORITY] > priority:
+                        entries[i] = self._reprioritize(e, priority)
+                        self.boosted += 1
+                entries.append(entry)
+
+            if key is not None:
+                self.keys[key] = entry
+
+            heapq.heappush(self.heap, entry)
+            self.unfinished += 1
+
+            if priority == PRIORITY_WARMUP and self.max_warmups > 0:
+                self._shed()
+
+            self.cond.notify_all()
+        return replaced
+
+    def discard(self, key):
+        with self.cond:
+            entry = self.keys.get(key)
+            if entry is not None:
+                self._remove(entry)
+
+    def get(self):
+        with self.cond:
+            while True:
+                while self.heap and not self.heap[0][self.ALIVE]:
+                    heapq.heappop(self.heap)
+                if self.heap:
+                    break
+                self.cond.wait()
+            entry = heapq.heappop(self.heap)
+            self._unlink(entry)
+            return entry[self.NAME], entry[self.TASK]
+
+    def task_done(self):
+        with self.cond:
+            self.unfinished -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return dict(queued=self.unfinished,
+                        coalesced=self.coalesced,
+                        shed=self.shed,
+                        boosted=self.boosted)
+
+    def _reprioritize(self, entry, priority):
+        # the heap can't be updated in place, queue a copy with the same
+        # sequence number instead
+        entry[self.ALIVE] = False
+        entry = [priority] + entry[1:self.ALIVE] + [True]
+        if entry[self.KEY] is not None:
+            self.keys[entry[self.KEY]] = entry
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def _unlink(self, entry):
+        entry[self.ALIVE] = False
+        filepath = entry[self.FILEPATH]
+        if filepath is not None:
+            entries = self.files[filepath]
+            entries.remove(entry)
+            if not entries:
+                del self.files[filepath]
+        key = entry[self.KEY]
+        if key is not None and self.keys.get(key) is entry:
+            del self.keys[key]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        self.unfinished -= 1
+        logger.debug('task %s for %s dropped', entry[self.NAME],
+                     entry[self.FILEPATH])
+        self.cond.notify_all()
+
+    def _shed(self):
+        # not the tasks raised to or from the warmup priority
+        warmups = sorted(e for e in self.heap
+                         if e[self.ALIVE] and
+                         e[self.PRIORITY] == e[self.ORIGIN] == PRIORITY_WARMUP)
+        for entry in warmups[: max(0, len(warmups) - self.max_warmups)]:
+            logger.info('queue is deep, shed task %s for %s',
+                        entry[self.NAME], entry[self.FILEPATH])
+            self._remove(entry)
+            self.shed += 1
+
+
+class Worker:
+    """A thread running the tasks of the files assigned to it, in order,
+    with its own libclang indexes, or its own worker process"""
+
+    def __init__(self, wid, library_path=None, on_restart=None,
+                 on_give_up=None, max_warmups=0):
+        self.wid = wid
+        self.process = None
+        if library_path is not None:
+            try:
+                self.process = WorkerProcess(wid, library_path, on_restart,
+                                             on_give_up)
+            except Exception as ex:
+                logger.exception('start worker process failed, parse in '
+                                 'the proc instead')
+        if self.process is None:
+            self.parse_in_proc()
+        self.queue = TaskQueue(max_warmups)
+        self.thread = threading.Thread(target=self.loop,
+                                       name='ncm2_pyclang-%s' % wid)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def parse_in_proc(self):
+        self.cmpl_index = cindex.Index.create(excludeDecls=False)
+        self.goto_index = cindex.Index.create(excludeDecls=False)
+        self.process = None
+
+    def put(self, name, task, priority=PRIORITY_BACKGROUND, filepath=None,
+            key=None):
+        return self.queue.put(name, task, priority, filepath, key)
+
+    def loop(self):
+        while True:
+            name, task = self.queue.get()
+            if task is None:
+                break
+            logger.info('worker %s begin task %s', self.wid, name)
+            try:
+                task()
+                logger.info('task %s finished', name)
+            except ErrTaskCancel as ex:
+                logger.info('task %s canceled, %s', name, ex)
+            except ErrWorkerCrash as ex:
+                logger.error('task %s lost, %s', name, ex)
+            except Exception as ex:
+                traceback.print_exc()
+                logger.exception('exception: %s', ex)
+            finally:
+                self.queue.task_done()
+
+
 class Source(Ncm2Source):
 
     def __init__(self, nvim):
@@ -41,34 +638,203 @@ class Source(Ncm2Source):
 
         cindex.Config.set_compatibility_check(False)
 
-        self.cmpl_index = cindex.Index.create(excludeDecls=False)
-        self.goto_index = cindex.Index.create(excludeDecls=False)
-
-        self.cmpl_tu = {}
-        self.goto_tu = {}
-
-        self.queue = queue.Queue()
-        self.worker = threading.Thread(target=self.worker_loop)
-        self.worker.daemon = True
-        self.worker.start()
+        self.tu_budget = TUBudget(nvim.vars['ncm2_pyclang#tu_cache_size'],
+                                  nvim.vars['ncm2_pyclang#tu_cache_memory'] << 20)
+        # one tu serves both completion and goto declaration, instead of a
+        # tu for each of them
+        self.shared_tu = nvim.vars['ncm2_pyclang#shared_tu']
+        if self.shared_tu:
+            self.cmpl_tu = self.goto_tu = TUCache('shared', self.tu_budget)
+        else:
+            self.cmpl_tu = TUCache('completion', self.tu_budget)
+            self.goto_tu = TUCache('goto', self.tu_budget)
+
+        self.timings = Timings()
+
+        self.mirror = BufferMirror()
+
+        # filepath -> context_id of the newest completion request
+        self.pending_completions = {}
+        self.completion_lock = threading.Lock()
+        self.completion_stats = dict(requests=0, superseded=0, completed=0,
+                                     canceled={})
+
+        # seconds before an asynchronous goto declaration gives up
+        self.goto_deadline = nvim.vars['ncm2_pyclang#goto_deadline']
+        self.goto_lock = threading.Lock()
+        # request id -> [future, deadline timer]
+        self.goto_requests = {}
+        # (filepath, changedtick, lnum, bcol) -> future
+        self.goto_inflight = {}
+        self.goto_stats = dict(requests=0, reused=0, answered=0, timeouts=0,
+                               canceled=0)
+
+        # tasks of a file always run on the same worker, so that they are
+        # ordered, while different files are parsed in parallel
+        workers = nvim.vars['ncm2_pyclang#workers']
+        if workers <= 0:
+            workers = min(4, os.cpu_count() or 1)
+        # libclang runs in worker processes, so that it doesn't crash the
+        # proc
+        process_library = None
+        if nvim.vars['ncm2_pyclang#worker_process']:
+            process_library = library_path
+        max_warmups = nvim.vars['ncm2_pyclang#max_queued_warmups']
+        self.process_give_ups = itertools.count()
+        self.workers = [Worker(i, process_library, self.on_worker_restart,
+                               self.on_worker_give_up, max_warmups)
+                        for i in range(workers)]
 
         gcc_path = nvim.vars['ncm2_pyclang#gcc_path']
 
         auto_detect = nvim.vars['ncm2_pyclang#detect_sys_inc_args']
 
-        sys_inc = {}
+        # completion works with the fallback until the detection is done
+        self.args_system_include = nvim.vars['ncm2_pyclang#sys_inc_args_fallback']
+
+        # compiler exe -> dict(c=..., cpp=...), None while it is being probed
+        # or if the probe has failed
+        self.sys_inc = {}
+        self.sys_inc_lock = threading.Lock()
+        # (compiler, directory) of compile commands -> compiler exe
+        self.compiler_exes = {}
+        # globs of the compilers of compile commands that may be run
+        self.query_driver = [path.expanduser(g) for g in
+                             nvim.vars['ncm2_pyclang#query_driver']]
+        self.auto_detect = auto_detect
+        self.default_compiler = None
+
         gcc_exe = find_executable(gcc_path)
         if auto_detect and gcc_exe:
+            self.default_compiler = gcc_exe
+            self.detect_system_include(gcc_exe)
+        elif auto_detect:
+            # warning if auto detection failed
+            nvim.call('ncm2_pyclang#warn', 'g:ncm2_pyclang#gcc_path(' + gcc_path \
+                    + ' exe not found, use ncm2_pyclang#sys_inc_args_fallback')
+
+        self.flags = FlagPipeline(nvim.vars['ncm2_pyclang#flag_providers'])
+
+        file_watcher = nvim.vars['ncm2_pyclang#file_watcher']
+        if file_watcher:
+            watcher.add_listener(self.on_file_changed)
+            watcher.start(use_inotify=(file_watcher == 'inotify'),
+                          poll_interval=nvim.vars['ncm2_pyclang#watch_poll_interval'])
+
+    sys_inc_cache = 'system_include.json'
+
+    def detect_system_include(self, gcc_exe):
+        """Returns the system include args of the compiler, or None if they
+        are not known yet. The compiler is probed in the background only
+        once."""
+        gcc_exe = path.realpath(gcc_exe)
+
+        with self.sys_inc_lock:
+            if gcc_exe in self.sys_inc:
+                return self.sys_inc[gcc_exe]
+            self.sys_inc[gcc_exe] = None
+
+        try:
+            st = os.stat(gcc_exe)
+        except OSError as ex:
+            logger.exception('stat %s failed', gcc_exe)
+            return None
+
+        key = '%s:%s:%s' % (gcc_exe, st.st_mtime_ns, st.st_size)
+
+        cached = load_cache_json(self.sys_inc_cache).get(key)
+        if cached is not None:
+            logger.info('system include of %s %s loaded from cache',
+                        gcc_exe, cached['version'])
+            sys_inc = dict(c=cached['c'], cpp=cached['cpp'])
+            self.sys_inc[gcc_exe] = sys_inc
+            return sys_inc
+
+        t = threading.Thread(target=self.detect_system_include_task,
+                             args=(gcc_exe, key))
+        t.daemon = True
+        t.start()
+        return None
+
+    def detect_system_include_task(self, gcc_exe, key):
+        start = time.time()
+        try:
+            sys_inc = {}
             sys_inc['cpp'] = self.get_system_include(gcc_exe, ['-xc++'])
             sys_inc['c'] = self.get_system_include(gcc_exe, ['-xc'])
-        else:
-            if auto_detect:
-                # warning if auto detection failed
-                nvim.call('ncm2_pyclang#warn', 'g:ncm2_pyclang#gcc_path(' + gcc_path \
-                        + ' exe not found, use ncm2_pyclang#sys_inc_args_fallback')
-            sys_inc = nvim.vars['ncm2_pyclang#sys_inc_args_fallback']
+            version = self.get_compiler_version(gcc_exe)
+        except Exception as ex:
+            logger.exception('detect system include of %s failed', gcc_exe)
+            return
 
-        self.args_system_include = sys_inc
+        if not sys_inc['cpp'] and not sys_inc['c']:
+            # e.g. a compiler that doesn't speak gcc's options, keep using
+            # the default
+            logger.error('no system include found for %s', gcc_exe)
+            return
+
+        self.sys_inc[gcc_exe] = sys_inc
+        logger.info('system include of %s %s detected, time: %s',
+                    gcc_exe, version, time.time() - start)
+
+        try:
+            update_cache_json(self.sys_inc_cache, key,
+                              dict(version=version, **sys_inc))
+        except Exception as ex:
+            logger.exception('save system include cache failed')
+
+    def compiler_exe(self, compiler, directory):
+        if '/' not in compiler:
+            # looked up in $PATH, independent of the directory
+            directory = None
+        key = (compiler, directory)
+        if key in self.compiler_exes:
+            return self.compiler_exes[key]
+        if directory is not None:
+            exe = path.join(directory, compiler)
+            if not os.access(exe, os.X_OK):
+                exe = None
+        else:
+            exe = find_executable(compiler)
+        if exe is None:
+            logger.info('compiler %s not found', compiler)
+        elif not self.query_driver_allowed(exe):
+            # named by the project files, which may not be trusted
+            logger.warning('compiler %s is not allowed by '
+                           'g:ncm2_pyclang#query_driver', exe)
+            exe = None
+        self.compiler_exes[key] = exe
+        return exe
+
+    def query_driver_allowed(self, exe):
+        exe = path.abspath(exe)
+        exes = {exe, path.realpath(exe)}
+        return any(fnmatch.fnmatchcase(e, g)
+                   for g in self.query_driver for e in exes)
+
+    def system_include(self, compiler, directory, stdinc):
+        """The system include args for the compiler of a compile command,
+        the args of g:ncm2_pyclang#gcc_path are used until it has been
+        probed"""
+        sys_inc = None
+        if self.auto_detect:
+            if compiler:
+                exe = self.compiler_exe(compiler, directory)
+                if exe is not None:
+                    sys_inc = self.detect_system_include(exe)
+            if sys_inc is None and self.default_compiler:
+                sys_inc = self.detect_system_include(self.default_compiler)
+        if sys_inc is None:
+            sys_inc = self.args_system_include
+        return sys_inc[stdinc]
+
+    def get_compiler_version(self, gcc):
+        proc = Popen(args=[gcc, '-dumpversion'],
+                     stdin=subprocess.PIPE,
+                     stdout=subprocess.PIPE,
+                     stderr=subprocess.PIPE)
+        outdata, errdata = proc.communicate(timeout=2)
+        return outdata.decode().strip()
 
     def get_system_include(self, gcc, args):
 
@@ -87,7 +853,10 @@ class Source(Ncm2Source):
         #  /usr/include/x86_64-linux-gnu
         #  /usr/include
         # End of search list.
-        args += ['-E', '-Wp,-v', '-']
+        if 'clang' in path.basename(gcc):
+            args += ['-E', '-v', '-']
+        else:
+            args += ['-E', '-Wp,-v', '-']
 
         gcc_is_cygwin = sys.platform == 'win32'
 
@@ -113,9 +882,18 @@ class Source(Ncm2Source):
         lines = errdata.split('\n')
 
         res = []
+        searching = False
         for line in lines:
-            if line.startswith(' /'):
+            if line.startswith('#include <...> search starts here:'):
+                searching = True
+                continue
+            if line.startswith('End of search list.'):
+                break
+            if searching and line.startswith(' '):
                 inc_dir = line.strip()
+                # macOS
+                if inc_dir.endswith(' (framework directory)'):
+                    inc_dir = inc_dir[: -len(' (framework directory)')]
                 res += ['-isystem', prefix + inc_dir]
                 # cygwin uses symlink /usr/lib -> /lib, the directory cannot be
                 # accessed with Windows file explorer
@@ -125,46 +903,112 @@ class Source(Ncm2Source):
         logger.debug('system include: %s', res)
         return res
 
-    def join_queue(self):
-        if self.worker.is_alive() and \
-                self.worker is not threading.current_thread():
-            self.queue.join()
+    def worker_of(self, filepath):
+        return self.workers[hash(filepath) % len(self.workers)]
 
-    def worker_loop(self):
-        while True:
-            name, task = self.queue.get()
-            if task is None:
-                break
-            logger.info('begin task %s', name)
+    def submit(self, filepath, name, fn, priority):
+        """Queues fn on the worker of filepath, returns the Future of its
+        result. The worker runs it after the tasks of the file queued before
+        it, but also after the running task and the more urgent tasks of the
+        other files of the worker, so it is only worth waiting for when the
+        tus of the file are needed."""
+        future = Future()
+
+        def task():
+            if not future.set_running_or_notify_cancel():
+                return
             try:
-                task()
-                logger.info('task %s finished', name)
-            except ErrTaskCancel as ex:
-                logger.info('task %s canceled, %s', name, ex)
+                future.set_result(fn())
             except Exception as ex:
-                traceback.print_exc()
-                logger.exception('exception: %s', ex)
-            finally:
-                self.queue.task_done()
+                future.set_exception(ex)
+                raise
+
+        self.worker_of(filepath).put(name, task, priority, filepath)
+        return future
+
+    def on_worker_restart(self, process):
+        # called from the supervisor thread, parse the tus lost with the
+        # process again in the background
+        worker = self.workers[process.wid]
+        for cache in {self.cmpl_tu, self.goto_tu}:
+            for filepath, item in cache.items():
+                tu = item.get('tu')
+                if not isinstance(tu, RemoteTU) or tu.process is not process:
+                    continue
+                worker.put('rehydrate',
+                           lambda cache=cache, filepath=filepath, tu=tu:
+                           self.rehydrate_task(cache, filepath, tu),
+                           PRIORITY_BACKGROUND, filepath)
+
+    def on_worker_give_up(self, process):
+        # called from the supervisor thread, the worker parses in the proc
+        # from now on
+        worker = self.workers[process.wid]
+        worker.put('parse_in_proc',
+                   lambda: self.parse_in_proc_task(worker, process),
+                   PRIORITY_COMPLETION)
+        if next(self.process_give_ups) == 0:
+            msg = ('ncm2_pyclang worker process cannot start, '
+                   'parsing in the completion source instead')
+            self.nvim.async_call(
+                lambda: self.nvim.call('ncm2_pyclang#warn', msg))
+
+    def parse_in_proc_task(self, worker, process):
+        worker.parse_in_proc()
+        for cache in {self.cmpl_tu, self.goto_tu}:
+            for filepath, item in cache.items():
+                tu = item.get('tu')
+                if isinstance(tu, RemoteTU) and tu.process is process:
+                    cache.pop(filepath)
+
+    def rehydrate_task(self, cache, filepath, tu):
+        if filepath not in cache or cache[filepath].get('tu') is not tu:
+            # evicted or replaced in the meantime
+            return
+        if tu.ensure():
+            cache.measure(filepath)
 
     def notify(self, method: str, *args):
         self.nvim.call(method, *args, async_=True)
 
+    def on_file_changed(self, filepath):
+        # called from the watcher thread, each worker checks the tus of its
+        # own files
+        for worker in self.workers:
+            worker.put('file_changed',
+                       lambda worker=worker:
+                       self.file_changed_task(filepath, worker))
+
+    def file_changed_task(self, filepath, worker):
+        for cache in {self.cmpl_tu, self.goto_tu}:
+            for tu_path, item in cache.items():
+                if filepath not in item['deps']:
+                    continue
+                if self.worker_of(tu_path) is not worker:
+                    continue
+                check, deps = self.resolve_args(item['data'])
+                item['deps'] = deps
+                if check is not item['check']:
+                    cache.pop(tu_path)
+                    logger.info('%s changed, tu %s has been removed',
+                                filepath, tu_path)
+
     def get_args_dir(self, data):
-        self.join_queue()
+        # no tu involved, no need to wait for the worker
+        check, deps = self.resolve_args(data)
+        return [list(check.args), check.directory]
+
+    def resolve_args(self, data):
         context = data['context']
         cwd = data['cwd']
-        database_path = data['database_path']
         filepath = context['filepath']
-        args_file_path = data['args_file_path']
 
-        args, run_dir = args_from_cmake(filepath, cwd, database_path)
+        with track_deps() as deps:
+            args, run_dir, compiler, provider = self.flags.resolve(
+                filepath, cwd, data)
 
-        if args is None:
-            args, run_dir = args_from_kbuild(filepath, cwd)
-
-        if args is None:
-            args, run_dir = args_from_clang_complete(filepath, cwd, args_file_path)
+        logger.debug('%s args from provider %s, compiler %s',
+                     filepath, provider, compiler)
 
         if args is None:
             args = []
@@ -183,13 +1027,54 @@ class Source(Ncm2Source):
             stdinc = 'c'
 
         if '-nostdinc' not in args:
-            args += self.args_system_include[stdinc]
-
-        return [args, run_dir]
+            args += self.system_include(compiler, run_dir, stdinc)
+
+        return intern_args(args, run_dir), deps
+
+    def get_stats(self):
+        return dict(flag_providers=self.flags.stats(),
+                    tu_cache=self.tu_budget.stats(),
+                    completion=self.get_completion_stats(),
+                    goto=self.get_goto_stats(),
+                    shared_tu=self.shared_tu,
+                    timings=self.timings.stats(),
+                    buffers=self.mirror.stats(),
+                    queues=[w.queue.stats() for w in self.workers],
+                    worker_processes=[w.process.stats() for w in self.workers
+                                      if w.process is not None])
+
+    def get_completion_stats(self):
+        with self.completion_lock:
+            stats = dict(self.completion_stats)
+            stats['canceled'] = dict(stats['canceled'])
+            return stats
+
+    def sync_lines(self, context, lines):
+        bufnr = context['bufnr']
+        sent = lines
+        lines = self.mirror.update(bufnr, sent)
+        if lines is None:
+            logger.info('buffer %s (%s) is out of sync, asking for all of it',
+                        bufnr, context['filepath'])
+            self.nvim.call('ncm2_pyclang#resync', bufnr)
+        elif isinstance(sent, dict) and 'base' not in sent:
+            # deltas are sent only once we have got the whole buffer
+            self.notify('ncm2_pyclang#synced', bufnr, sent['changedtick'])
+        return lines
 
     def cache_add(self, data, lines):
-        self.join_queue()
-        self.do_cache_add(data, lines, True)
+        # only the newest warmup of a file is worth parsing
+        filepath = data['context']['filepath']
+        lines = self.sync_lines(data['context'], lines)
+        if lines is None:
+            return
+        self.worker_of(filepath).put(
+            'cache_add', lambda: self.cache_add_task(data, lines),
+            PRIORITY_WARMUP, filepath, ('cache_add', filepath))
+
+    def cache_add_task(self, data, lines):
+        if not self.shared_tu:
+            self.do_cache_add(data, lines, True)
         self.do_cache_add(data, lines, False)
 
     def do_cache_add(self, data, lines, for_completion):
@@ -197,7 +1082,7 @@ class Source(Ncm2Source):
         src = self.get_src("\n".join(lines), context)
         filepath = context['filepath']
         changedtick = context['changedtick']
-        args, directory = self.get_args_dir(data)
+        check, deps = self.resolve_args(data)
         start = time.time()
 
         if for_completion:
@@ -205,105 +1090,144 @@ class Source(Ncm2Source):
         else:
             cache = self.goto_tu
 
-        check = dict(args=args, directory=directory)
-        if filepath in cache:
-            item = cache[filepath]
-            if check == item['check']:
+        item = cache.lookup(filepath)
+        if item is not None:
+            if check is item['check']:
                 tu = item['tu']
+                item['data'] = data
+                item['deps'] = deps
                 if changedtick == item['changedtick']:
                     logger.info("changedtick is the same, skip reparse")
-                    return
-                self.reparse_tu(tu, filepath, src)
+                    cache.budget.touch(cache, filepath)
+                    return tu
+                self.reparse_tu(tu, filepath, src, cache.name)
+                item['changedtick'] = changedtick
+                cache.measure(filepath)
                 logger.debug("cache_add reparse existing done")
-                return
-            del cache[filepath]
+                return tu
+            cache.pop(filepath)
 
         item = {}
         item['check'] = check
         item['changedtick'] = changedtick
+        item['data'] = data
+        item['deps'] = deps
 
-        tu = self.create_tu(filepath, args, directory, src,
+        tu = self.create_tu(filepath, check.args, check.directory, src,
                             for_completion=for_completion)
         item['tu'] = tu
 
         cache[filepath] = item
 
+        if not for_completion:
+            self.learn_includes(data, tu, check.directory)
+
         end = time.time()
         logger.debug("cache_add done cmpl[%s]. time: %s",
                      for_completion,
                      end - start)
+        return tu
 
-    def cache_del(self, filepath):
-        self.join_queue()
-        if filepath in self.cmpl_tu:
-            del self.cmpl_tu[filepath]
+    def learn_includes(self, data, tu, directory):
+        if isinstance(tu, RemoteTU):
+            headers = set(tu.includes)
+        else:
+            headers = tu_includes(tu, directory)
+        learned = learn_header_owners(data['context']['filepath'],
+                                      data['cwd'],
+                                      data['database_path'],
+                                      headers,
+                                      data['database_discover_depth'],
+                                      data['database_backend'])
+        if learned:
+            self.flags.forget(learned)
+
+    def cache_del(self, filepath, bufnr=None):
+        if bufnr is not None:
+            self.mirror.discard(bufnr)
+        worker = self.worker_of(filepath)
+        # no need to parse a deleted buffer
+        worker.queue.discard(('cache_add', filepath))
+        with self.completion_lock:
+            self.pending_completions.pop(filepath, None)
+        worker.put('cache_del', lambda: self.drop_tus(filepath),
+                   PRIORITY_BACKGROUND, filepath)
+
+    def drop_tus(self, filepath):
+        if self.cmpl_tu.pop(filepath) is not None:
             logger.info('completion cache %s has been removed', filepath)
-        if filepath in self.goto_tu:
-            del self.goto_tu[filepath]
+        if self.goto_tu.pop(filepath) is not None:
             logger.info('goto cache %s has been removed', filepath)
 
-    def get_tu(self, filepath, args, directory, src, for_completion=False):
+    def get_tu(self, filepath, check, src, changedtick, for_completion=False,
+               check_cancel=None):
+        if check_cancel is not None:
+            # about to (re)parse, which is the expensive part
+            check_cancel()
+
         if for_completion:
             cache = self.cmpl_tu
         else:
             cache = self.goto_tu
 
-        check = dict(args=args, directory=directory)
-        if filepath in cache:
-            item = cache[filepath]
+        item = cache.lookup(filepath)
+        if item is not None:
             tu = item['tu']
-            if check == item['check']:
+            if check is item['check']:
                 logger.info("%s tu is cached", filepath)
-                self.reparse_tu(tu, filepath, src)
-                return item['tu']
+                self.reparse_tu(tu, filepath, src, cache.name)
+                # the tu may be shared with goto declaration
+                item['changedtick'] = changedtick
+                cache.measure(filepath)
+                return tu
             logger.info("%s tu invalidated by check %s -> %s",
                         filepath, check, item['check'])
-            self.cache_del(filepath)
+            self.drop_tus(filepath)
 
         logger.info("cache miss")
 
         return self.create_tu(filepath,
-                              args,
-                              directory,
+                              check.args,
+                              check.directory,
                               src,
                               for_completion=for_completion)
 
     def create_tu(self, filepath, args, directory, src, for_completion):
+        if self.shared_tu:
+            name = 'shared'
+        elif not for_completion:
+            name = 'goto'
+        else:
+            name = 'completion'
 
-        CXTranslationUnit_KeepGoing = 0x200
-        CXTranslationUnit_CreatePreambleOnFirstParse = 0x100
-
-        args = ['-working-directory=' + directory] + args
+        worker = self.worker_of(filepath)
+        start = time.time()
 
-        if not for_completion:
-            flags = cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | \
-                cindex.TranslationUnit.PARSE_INCOMPLETE | \
-                CXTranslationUnit_CreatePreambleOnFirstParse | \
-                cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD | \
-                CXTranslationUnit_KeepGoing
+        if worker.process is not None:
+            tu = RemoteTU(worker.process, name, filepath, args, directory,
+                          src)
         else:
-            flags = cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | \
-                cindex.TranslationUnit.PARSE_INCOMPLETE | \
-                CXTranslationUnit_CreatePreambleOnFirstParse | \
-                cindex.TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS | \
-                cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | \
-                CXTranslationUnit_KeepGoing
+            args = ['-working-directory=' + directory] + list(args)
+            flags = parse_flags(name)
+            logger.info("flags %s", flags)
 
-        logger.info("flags %s", flags)
+            unsaved = (filepath, src)
 
-        unsaved = (filepath, src)
+            if name == 'completion':
+                index = worker.cmpl_index
+            else:
+                index = worker.goto_index
 
-        if for_completion:
-            index = self.cmpl_index
-        else:
-            index = self.goto_index
+            tu = index.parse(filepath, args, [unsaved], flags)
 
-        tu = index.parse(filepath, args, [unsaved], flags)
+        self.timings.add(name + '_parse', time.time() - start)
         return tu
 
-    def reparse_tu(self, tu, filepath, src):
+    def reparse_tu(self, tu, filepath, src, name):
         unsaved = (filepath, src)
+        start = time.time()
         tu.reparse([unsaved])
+        self.timings.add(name + '_reparse', time.time() - start)
 
     include_pat = re.compile(r'^\s*#include\s+["<]([^"<]*)$')
     include_base_pat = re.compile(r'([^/"<]*)$')
@@ -370,16 +1294,33 @@ class Source(Ncm2Source):
         self.nvim.async_call(cb)
 
     def on_complete(self, context, data, lines):
-        self.on_complete_context_id = context['context_id']
-        self.queue.put(['on_complete',
-                        lambda: self.on_complete_task(context, data, lines)])
+        filepath = context['filepath']
+        lines = self.sync_lines(context, lines)
+        if lines is None:
+            # the next keystroke brings the whole buffer
+            return
+        with self.completion_lock:
+            self.pending_completions[filepath] = context['context_id']
+            self.completion_stats['requests'] += 1
+        # the older request of the buffer still in the queue is dropped
+        superseded = self.worker_of(filepath).put(
+            'on_complete', lambda: self.on_complete_task(context, data, lines),
+            PRIORITY_COMPLETION, filepath, ('on_complete', filepath))
+        if superseded:
+            with self.completion_lock:
+                self.completion_stats['superseded'] += 1
 
     def on_complete_task(self, context, data, lines):
         context_id = context['context_id']
+        filepath = context['filepath']
 
-        def check_context_id(info, *args):
-            if context_id != self.on_complete_context_id:
-                raise ErrTaskCancel(info % (*args,))
+        def check_context_id(phase, detail=''):
+            if context_id == self.pending_completions.get(filepath):
+                return
+            with self.completion_lock:
+                canceled = self.completion_stats['canceled']
+                canceled[phase] = canceled.get(phase, 0) + 1
+            raise ErrTaskCancel(phase + detail)
 
         data['context'] = context
         src = self.get_src("\n".join(lines), context)
@@ -392,21 +1333,21 @@ class Source(Ncm2Source):
 
         check_context_id('get_args_dir')
 
-        args, directory = self.get_args_dir(data)
+        check, deps = self.resolve_args(data)
 
         inc_match = self.include_pat.search(typed)
         if inc_match:
             self.get_include_completions(data,
-                                         args,
-                                         directory,
+                                         check.args,
+                                         check.directory,
                                          inc_match.group(1))
             return
 
         start = time.time()
 
-        check_context_id('get_tu')
-
-        tu = self.get_tu(filepath, args, directory, src)
+        tu = self.get_tu(filepath, check, src, context['changedtick'],
+                         for_completion=True,
+                         check_cancel=lambda: check_context_id('reparse'))
 
         check_context_id('codeComplete')
 
@@ -420,13 +1361,14 @@ class Source(Ncm2Source):
         results = cr.results
 
         cr_end = time.time()
+        self.timings.add('complete', cr_end - start)
 
         matcher = self.matcher_get(context['matcher'])
 
         matches = []
         for i, res in enumerate(results):
             now = time.time()
-            check_context_id('complete result %s/%s', i + 1, len(results))
+            check_context_id('format', ' %s/%s' % (i + 1, len(results)))
             item = self.format_complete_item(context, matcher, base, res)
             if item is None:
                 continue
@@ -442,6 +1384,9 @@ class Source(Ncm2Source):
         logger.debug("total time: %s, codeComplete time: %s, matches %s -> %s",
                      end - start, cr_end - start, len(results), len(matches))
 
+        with self.completion_lock:
+            self.completion_stats['completed'] += 1
+
         cb = lambda: self.complete(context, startccol, matches)
         self.nvim.async_call(cb)
 
@@ -528,48 +1473,147 @@ class Source(Ncm2Source):
         return '${%s:%s}' % (num, txt)
 
     def find_declaration(self, data, lines):
-        self.join_queue()
+        filepath = data['context']['filepath']
+        lines = self.sync_lines(data['context'], lines)
+        if lines is None:
+            self.nvim.call('ncm2_pyclang#error', 'buffer out of sync, try again')
+            return {}
+        try:
+            ret, diagnostics = self.declaration_future(data, lines).result(
+                self.goto_deadline)
+        except FutureTimeoutError:
+            with self.goto_lock:
+                self.goto_stats['timeouts'] += 1
+            self.nvim.call('ncm2_pyclang#error',
+                           'no declaration found within %s seconds'
+                           % self.goto_deadline)
+            return {}
+        except CancelledError:
+            # shared with an asynchronous lookup which has been canceled
+            return {}
+        if ret is not None:
+            return ret
 
-        context = data['context']
-        src = self.get_src("\n".join(lines), context)
-        filepath = context['filepath']
-        bcol = context['bcol']
-        lnum = context['lnum']
+        # we failed finding the declaration, maybe there's some syntax error
+        # stopping us. Report it to the user.
+        for diag in diagnostics:
+            self.nvim.call('ncm2_pyclang#error', diag)
+        return {}
 
-        args, directory = self.get_args_dir(data)
+    def find_declaration_async(self, request_id, data, lines):
+        """Looks for the declaration in the background, the result is sent
+        to ncm2_pyclang#on_declaration. The same request while the former
+        one is still going shares its parse."""
+        filepath = data['context']['filepath']
+        lines = self.sync_lines(data['context'], lines)
+        if lines is None:
+            self.nvim.call('ncm2_pyclang#on_declaration', request_id, {},
+                           ['buffer out of sync, try again'])
+            return
 
-        tu = self.get_tu(filepath, args, directory, src)
+        future = self.declaration_future(data, lines)
+        with self.goto_lock:
+            timer = threading.Timer(self.goto_deadline,
+                                    lambda: self.on_declaration_timeout(
+                                        request_id))
+            timer.daemon = True
+            self.goto_requests[request_id] = [future, timer]
+
+        timer.start()
+        future.add_done_callback(
+            lambda f: self.on_declaration_done(request_id, f))
+
+    def declaration_future(self, data, lines):
+        """The Future of the declaration lookup, shared with the same lookup
+        still going"""
+        context = data['context']
+        filepath = context['filepath']
+        key = (filepath, context['changedtick'], context['lnum'],
+               context['bcol'])
+
+        with self.goto_lock:
+            self.goto_stats['requests'] += 1
+            future = self.goto_inflight.get(key)
+            if future is not None:
+                self.goto_stats['reused'] += 1
+                return future
+            future = self.submit(
+                filepath, 'find_declaration',
+                lambda: self.find_declaration_task(data, lines),
+                PRIORITY_GOTO)
+            self.goto_inflight[key] = future
+
+        future.add_done_callback(lambda f: self.goto_inflight.pop(key, None))
+        return future
+
+    def cancel_declaration(self, request_id):
+        with self.goto_lock:
+            request = self.goto_requests.pop(request_id, None)
+            if request is None:
+                return
+            future, timer = request
+            timer.cancel()
+            self.goto_stats['canceled'] += 1
+            # a parse that hasn't started is dropped, unless another request
+            # is waiting for it
+            if all(r[0] is not future for r in self.goto_requests.values()):
+                future.cancel()
+
+    def answer_declaration(self, request_id, pos, errors):
+        with self.goto_lock:
+            request = self.goto_requests.pop(request_id, None)
+            if request is None:
+                # canceled, or answered by the deadline
+                return False
+            request[1].cancel()
+            self.goto_stats['answered'] += 1
+        self.nvim.async_call(
+            lambda: self.nvim.call('ncm2_pyclang#on_declaration',
+                                   request_id, pos or {}, errors))
+        return True
+
+    def on_declaration_timeout(self, request_id):
+        if self.answer_declaration(
+                request_id, None,
+                ['no declaration found within %s seconds, the parse goes on '
+                 'in the background' % self.goto_deadline]):
+            with self.goto_lock:
+                self.goto_stats['timeouts'] += 1
+
+    def on_declaration_done(self, request_id, future):
+        if future.cancelled():
+            return
+        ex = future.exception()
+        if ex is not None:
+            self.answer_declaration(request_id, None, [str(ex)])
+            return
+        ret, diagnostics = future.result()
+        self.answer_declaration(request_id, ret, diagnostics)
 
-        f = File.from_name(tu, filepath)
-        location = SourceLocation.from_position(tu, f, lnum, bcol)
-        cursor = Cursor.from_location(tu, location)
+    def get_goto_stats(self):
+        with self.goto_lock:
+            return dict(self.goto_stats, pending=len(self.goto_requests))
 
-        defs = [cursor.get_definition(), cursor.referenced]
-        for d in defs:
-            if d is None:
-                logger.info("d None")
-                continue
+    def find_declaration_task(self, data, lines):
+        context = data['context']
+        filepath = context['filepath']
+        bcol = context['bcol']
+        lnum = context['lnum']
 
-            d_loc = d.location
-            if d_loc.file is None:
-                logger.info("location.file None")
-                continue
+        start = time.time()
 
-            ret = {}
-            ret['file'] = d_loc.file.name
-            ret['lnum'] = d_loc.line
-            ret['bcol'] = d_loc.column
-            return ret
+        # the tu is kept, so that looking up another symbol of the same
+        # changedtick doesn't reparse
+        tu = self.do_cache_add(data, lines, False)
 
-        # we failed finding the declaration, maybe there's some syntax error
-        # stopping us. Report it to the user.
-        logger.info('reading Diagnostic for this tu, args: %s', args)
-        for diag in tu.diagnostics:
-            # type: Diagnostic
-            if diag.severity < diag.Error:
-                pass
-            self.nvim.call('ncm2_pyclang#error', diag.format())
-        return {}
+        if isinstance(tu, RemoteTU):
+            ret, diagnostics = tu.declaration(filepath, lnum, bcol)
+        else:
+            ret, diagnostics = declaration_at(tu, filepath, lnum, bcol)
+        self.timings.add('goto', time.time() - start)
+        if ret is None:
+            logger.info('reading Diagnostic for the tu of %s', filepath)
+        return ret, diagnostics
 
 
 source = Source(vim)
@@ -577,5 +1621,8 @@ source = Source(vim)
 on_complete = source.on_complete
 cache_add = source.cache_add
 find_declaration = source.find_declaration
+find_declaration_async = source.find_declaration_async
+cancel_declaration = source.cancel_declaration
 cache_del = source.cache_del
 get_args_dir = source.get_args_dir
+get_stats = source.get_stats
@@ -0,0 +1,199 @@
+from ncm2 import getLogger
+from os.path import dirname, basename, join
+import os
+import select
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+
+logger = getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+
+_event_header = struct.Struct('iIII')
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+class _Inotify:
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.fd = fd
+
+    def add_watch(self, d):
+        wd = self._add_watch(self.fd, os.fsencode(d), IN_MASK)
+        if wd < 0:
+            return None
+        return wd
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, pos)
+            pos += _event_header.size
+            name = data[pos: pos + length].rstrip(b'\0')
+            pos += length
+            yield wd, mask, os.fsdecode(name)
+
+
+class FileWatcher:
+    """Notifies listeners when watched files are created, changed or
+    removed. Directories are watched with inotify when available, paths in
+    directories that cannot be watched are polled."""
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.inotify = None
+        self.poll_interval = 2.0
+        # inotify watched directory -> names of interest
+        self.dirs = {}
+        self.wds = {}
+        # polled path -> file_stamp
+        self.polled = {}
+
+    def start(self, use_inotify=True, poll_interval=2.0):
+        if self.active:
+            return
+
+        self.poll_interval = poll_interval
+
+        if use_inotify:
+            try:
+                self.inotify = _Inotify()
+            except Exception as ex:
+                logger.exception('inotify is not available, polling')
+
+        t = threading.Thread(target=self._loop)
+        t.daemon = True
+        t.start()
+
+        self.active = True
+        logger.info('file watcher started, inotify: %s, poll interval: %s',
+                    self.inotify is not None, poll_interval)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def watch(self, path):
+        if not self.active:
+            return
+
+        d = dirname(path)
+        name = basename(path)
+
+        with self.lock:
+            names = self.dirs.get(d)
+            if names is not None:
+                names.add(name)
+                return
+
+            if path in self.polled:
+                return
+
+            if self.inotify is not None:
+                wd = self.inotify.add_watch(d)
+                if wd is not None:
+                    self.dirs[d] = {name}
+                    self.wds[wd] = d
+                    return
+
+            self.polled[path] = file_stamp(path)
+
+    def _fire(self, paths):
+        for path in paths:
+            logger.debug('file changed: %s', path)
+            for listener in self.listeners:
+                try:
+                    listener(path)
+                except Exception as ex:
+                    logger.exception('file watcher listener failed')
+
+    def _loop(self):
+        next_poll = time.time() + self.poll_interval
+        while True:
+            timeout = max(0, next_poll - time.time())
+            if self.inotify is not None:
+                ready, _, _ = select.select([self.inotify.fd], [], [], timeout)
+                if ready:
+                    self._fire(self._inotify_changes())
+            else:
+                time.sleep(timeout)
+
+            if time.time() >= next_poll:
+                self._fire(self._poll_changes())
+                next_poll = time.time() + self.poll_interval
+
+    def _inotify_changes(self):
+        changed = []
+        with self.lock:
+            for wd, mask, name in self.inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    for d, names in self.dirs.items():
+                        changed += [join(d, n) for n in names]
+                    continue
+
+                d = self.wds.get(wd)
+                if d is None:
+                    continue
+
+                if mask & IN_IGNORED:
+                    # the directory itself has gone, poll the paths in it
+                    # until it shows up again
+                    del self.wds[wd]
+                    names = self.dirs.pop(d, set())
+                    for n in names:
+                        self.polled[join(d, n)] = None
+                    changed += [join(d, n) for n in names]
+                    continue
+
+                if name in self.dirs[d]:
+                    changed.append(join(d, name))
+        return changed
+
+    def _poll_changes(self):
+        changed = []
+        with self.lock:
+            polled = list(self.polled.items())
+        for path, stamp in polled:
+            if file_stamp(path) != stamp:
+                changed.append(path)
+        for path in changed:
+            # its directory may be watchable now
+            with self.lock:
+                self.polled.pop(path, None)
+            self.watch(path)
+        return changed
+
+
+watcher = FileWatcher()
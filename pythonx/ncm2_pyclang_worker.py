@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+# libclang worker process. The translation units of a shard of the files live
+# here, so that a crash of libclang doesn't take the whole proc down with all
+# of its translation units. Requests and replies are length prefixed json on
+# stdin/stdout.
+#
+# This module is also imported by the proc for the libclang helpers, it must
+# not import vim or ncm2.
+
+from os import path
+import ctypes
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+_header = struct.Struct('>I')
+
+
+def send_msg(f, msg):
+    data = json.dumps(msg).encode()
+    f.write(_header.pack(len(data)) + data)
+    f.flush()
+
+
+def recv_msg(f):
+    head = f.read(_header.size)
+    if len(head) < _header.size:
+        raise EOFError('worker pipe closed')
+    size, = _header.unpack(head)
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError('worker pipe closed')
+    return json.loads(data.decode())
+
+
+CXTranslationUnit_KeepGoing = 0x200
+CXTranslationUnit_CreatePreambleOnFirstParse = 0x100
+
+
+def parse_flags(kind):
+    """Parse options of a 'completion', 'goto' or 'shared' translation
+    unit"""
+    from clang.cindex import TranslationUnit
+
+    flags = TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | \
+        TranslationUnit.PARSE_INCOMPLETE | \
+        CXTranslationUnit_CreatePreambleOnFirstParse | \
+        CXTranslationUnit_KeepGoing
+
+    if kind == 'completion':
+        flags |= TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS | \
+            TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
+    elif kind == 'goto':
+        flags |= TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    else:
+        # bodies are needed by goto declaration
+        flags |= TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS | \
+            TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    return flags
+
+
+class _CXTUResourceUsageEntry(ctypes.Structure):
+    _fields_ = [('kind', ctypes.c_int), ('amount', ctypes.c_ulong)]
+
+
+class _CXTUResourceUsage(ctypes.Structure):
+    _fields_ = [('data', ctypes.c_void_p),
+                ('numEntries', ctypes.c_uint),
+                ('entries', ctypes.POINTER(_CXTUResourceUsageEntry))]
+
+
+_resource_usage_funcs = None
+
+
+def tu_memory_usage(tu):
+    """Bytes used by the translation unit, as reported by libclang"""
+    global _resource_usage_funcs
+    if _resource_usage_funcs is None:
+        from clang import cindex
+        # not bound by cindex.py
+        lib = cindex.conf.lib
+        get_usage = lib.clang_getCXTUResourceUsage
+        get_usage.argtypes = [cindex.c_object_p]
+        get_usage.restype = _CXTUResourceUsage
+        dispose_usage = lib.clang_disposeCXTUResourceUsage
+        dispose_usage.argtypes = [_CXTUResourceUsage]
+        dispose_usage.restype = None
+        _resource_usage_funcs = get_usage, dispose_usage
+
+    get_usage, dispose_usage = _resource_usage_funcs
+    usage = get_usage(tu)
+    try:
+        return sum(usage.entries[i].amount for i in range(usage.numEntries))
+    finally:
+        dispose_usage(usage)
+
+
+def tu_includes(tu, directory):
+    headers = set()
+    for inc in tu.get_includes():
+        headers.add(path.normpath(path.join(directory, inc.include.name)))
+    return headers
+
+
+def declaration_at(tu, filepath, lnum, bcol):
+    """Returns ({file, lnum, bcol}, []) for the declaration of the symbol at
+    the position, or (None, diagnostics) if it is not found, maybe because of
+    some syntax error"""
+    from clang.cindex import SourceLocation, Cursor, File
+
+    f = File.from_name(tu, filepath)
+    location = SourceLocation.from_position(tu, f, lnum, bcol)
+    cursor = Cursor.from_location(tu, location)
+
+    defs = [cursor.get_definition(), cursor.referenced]
+    for d in defs:
+        if d is None:
+            logger.info("d None")
+            continue
+
+        d_loc = d.location
+        if d_loc.file is None:
+            logger.info("location.file None")
+            continue
+
+        ret = {}
+        ret['file'] = d_loc.file.name
+        ret['lnum'] = d_loc.line
+        ret['bcol'] = d_loc.column
+        return ret, []
+
+    return None, [diag.format() for diag in tu.diagnostics]
+
+
+_chunk_kind_numbers = None
+
+
+def serialize_completion_string(string):
+    global _chunk_kind_numbers
+    if _chunk_kind_numbers is None:
+        from clang.cindex import completionChunkKindMap
+        _chunk_kind_numbers = {kind: num for num, kind
+                               in completionChunkKindMap.items()}
+
+    return [[_chunk_kind_numbers[chunk.kind], chunk.spelling,
+             serialize_completion_string(chunk.string)
+             if chunk.isKindOptional() else None]
+            for chunk in string]
+
+
+class SerializedChunk:
+    """A CompletionChunk received from a worker process"""
+
+    __slots__ = ('kind_number', 'spelling', 'string')
+
+    def __init__(self, kind_number, spelling, string):
+        self.kind_number = kind_number
+        self.spelling = spelling
+        if string is not None:
+            string = [SerializedChunk(*c) for c in string]
+        self.string = string
+
+    def isKindOptional(self):
+        return self.kind_number == 0
+
+    def isKindTypedText(self):
+        return self.kind_number == 1
+
+    def isKindPlaceHolder(self):
+        return self.kind_number == 3
+
+    def isKindInformative(self):
+        return self.kind_number == 4
+
+    def isKindResultType(self):
+        return self.kind_number == 15
+
+
+class SerializedResult:
+    """A CodeCompletionResult received from a worker process"""
+
+    __slots__ = ('string',)
+
+    def __init__(self, string):
+        self.string = [SerializedChunk(*c) for c in string]
+
+
+class ErrMissingTU(Exception):
+    pass
+
+
+class WorkerServer:
+    """The translation units of the worker, by the id given by the proc"""
+
+    def __init__(self, library_path):
+        from clang import cindex
+
+        if path.isdir(library_path):
+            cindex.Config.set_library_path(library_path)
+        elif path.isfile(library_path):
+            cindex.Config.set_library_file(library_path)
+
+        cindex.Config.set_compatibility_check(False)
+
+        self.cmpl_index = cindex.Index.create(excludeDecls=False)
+        self.goto_index = cindex.Index.create(excludeDecls=False)
+        self.tus = {}
+
+    def tu(self, tu_id):
+        tu = self.tus.get(tu_id)
+        if tu is None:
+            raise ErrMissingTU(tu_id)
+        return tu
+
+    def parse(self, tu_id, kind, filepath, args, directory, src):
+        args = ['-working-directory=' + directory] + list(args)
+        if kind == 'completion':
+            index = self.cmpl_index
+        else:
+            index = self.goto_index
+        tu = index.parse(filepath, args, [(filepath, src)], parse_flags(kind))
+        self.tus[tu_id] = tu
+        includes = []
+        if kind != 'completion':
+            includes = sorted(tu_includes(tu, directory))
+        return dict(memory=tu_memory_usage(tu), includes=includes)
+
+    def reparse(self, tu_id, filepath, src):
+        tu = self.tu(tu_id)
+        tu.reparse([(filepath, src)])
+        return dict(memory=tu_memory_usage(tu))
+
+    def dispose(self, tu_ids):
+        for tu_id in tu_ids:
+            self.tus.pop(tu_id, None)
+
+    def complete(self, tu_id, filepath, src, lnum, bcol):
+        tu = self.tu(tu_id)
+        cr = tu.codeComplete(filepath,
+                             lnum,
+                             bcol,
+                             [(filepath, src)],
+                             include_macros=True,
+                             include_code_patterns=True)
+        return [serialize_completion_string(res.string) for res in cr.results]
+
+    def declaration(self, tu_id, filepath, lnum, bcol):
+        return declaration_at(self.tu(tu_id), filepath, lnum, bcol)
+
+    def serve(self, fin, fout):
+        while True:
+            try:
+                msg = recv_msg(fin)
+            except EOFError:
+                return
+            # disposing is piggybacked on the next request
+            self.dispose(msg.get('dispose', []))
+            start = time.time()
+            try:
+                result = getattr(self, msg['method'])(**msg['params'])
+                reply = dict(result=result)
+            except ErrMissingTU as ex:
+                reply = dict(error='missing', message=str(ex))
+            except Exception as ex:
+                logger.exception('%s failed', msg['method'])
+                reply = dict(error='exception', message=str(ex))
+            logger.debug('%s done, time: %s', msg['method'],
+                         time.time() - start)
+            send_msg(fout, reply)
+
+
+def main():
+    log_file = os.environ.get('NVIM_PYTHON_LOG_FILE')
+    if log_file:
+        logging.basicConfig(
+            filename='%s_ncm2_pyclang_worker_%s' % (log_file, os.getpid()),
+            level=os.environ.get('NVIM_PYTHON_LOG_LEVEL', 'INFO').upper())
+
+    sys.path.insert(0, path.join(path.dirname(__file__), '3rd'))
+
+    # the protocol owns stdout, nothing else may write to it
+    fin = sys.stdin.buffer
+    fout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    server = WorkerServer(sys.argv[1])
+    server.serve(fin, fout)
+
+
+if __name__ == '__main__':
+    main()